@@ -2,14 +2,17 @@
 # -*- coding:utf-8 -*-
 # __author__ = '__Jack__'
 
-import time
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from coronavirus import application
-from tutorial import app03, app04, app05, app06  # , app07,app08
+from tutorial import app03, app04, app05, app06, app07  # ,app08
+from tutorial.chapter06 import secret_hasher_jwt, token_verifier_jwt
+from tutorial.chapter07 import cache_py_province_cache, cache_py_response_cache, job_py_SyncScheduler
+from tutorial.chapter07 import cache_py_fragment_cache, database_py_QueryStatsMiddleware, database_py_query_metrics
+from tutorial.chapter08 import MetricsMiddleware, metrics_registry
 
 # 异常处理类
 # from fastapi.exceptions import RequestValidationError
@@ -50,14 +53,30 @@ app.mount(path='/static', app=StaticFiles(directory='./coronavirus/static'),
 #     return PlainTextResponse(str(exc), status_code=400)
 
 
-@app.middleware('http')
-# call_next将接收request请求做为参数
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers['X-Process-Time'] = str(process_time)  # 添加自定义的以“X-”开头的请求头
-    return response
+# @app.middleware('http')
+# # call_next将接收request请求做为参数
+# async def add_process_time_header(request: Request, call_next):
+#     start_time = time.time()
+#     response = await call_next(request)
+#     process_time = time.time() - start_time
+#     response.headers['X-Process-Time'] = str(process_time)  # 添加自定义的以“X-”开头的请求头
+#     return response
+
+# 上面的中间件只添加一个X-Process-Time响应头,并且用的是墙上时钟time.time();
+# 改用纯ASGI的指标中间件: 按路由模板和状态码记录延迟直方图等指标(仍然添加X-Process-Time响应头),由/metrics输出
+app.add_middleware(MetricsMiddleware, registry=metrics_registry)
+app.add_route('/metrics', metrics_registry.endpoint, include_in_schema=False)
+# 每个请求执行的SQL条数和耗时: X-DB-Queries/X-DB-Time响应头,慢查询日志见CHAPTER07_SLOW_QUERY_MS
+app.add_middleware(database_py_QueryStatsMiddleware)
+metrics_registry.register_stats('chapter07_db', database_py_query_metrics.stats, '第七章SQL查询',
+                                counters=('queries', 'query_seconds', 'slow_queries', 'requests'))
+metrics_registry.register_stats('chapter07_province_cache', cache_py_province_cache.stats, '第七章省份缓存')
+metrics_registry.register_stats('chapter07_response_cache', cache_py_response_cache.stats, '第七章响应缓存')
+metrics_registry.register_stats('chapter07_fragment_cache', cache_py_fragment_cache.stats, '第七章页面片段缓存')
+metrics_registry.register_stats('chapter06_token_cache', token_verifier_jwt.stats, '第六章jwt-token校验缓存',
+                                counters=('hits', 'misses', 'failures', 'revocations'))
+metrics_registry.register_stats('chapter06_secret_hasher', secret_hasher_jwt.stats, '第六章密码哈希线程池',
+                                counters=('rejected',))
 
 
 app.add_middleware(
@@ -76,11 +95,26 @@ app.include_router(app03, prefix='/chapter03', tags=['第三章 请求参数和
 app.include_router(app04, prefix='/chapter04', tags=['第四章 响应处理和FastAPI配置'])
 app.include_router(app05, prefix='/chapter05', tags=['第五章 FastAPI的依赖注入系统'])
 app.include_router(app06, prefix='/chapter06', tags=['第六章 安全、认证和授权'])
-# app.include_router(app07, prefix='/chapter07',
-#                    tags=['第七章 FastAPI的数据库操作和多应用的目录结构设计'])
+app.include_router(app07, prefix='/chapter07',
+                   tags=['第七章 FastAPI的数据库操作和多应用的目录结构设计'])
 # app.include_router(app08, prefix='/chapter08', tags=['第八章 中间件、CORS、后台任务、测试用例'])
 app.include_router(application, prefix='/coronavirus', tags=['新冠病毒疫情跟踪器API'])
 
+# 应用的生命周期: 启动时开始定时同步新冠数据(间隔见CHAPTER07_SYNC_INTERVAL,为0则不启用),关闭时停止
+# 读请求只读本地数据库,不会在请求中触发同步
+sync_scheduler = job_py_SyncScheduler()
+
+
+@app.on_event('startup')
+def start_sync_scheduler():
+    sync_scheduler.start()
+
+
+@app.on_event('shutdown')
+def stop_sync_scheduler():
+    sync_scheduler.stop()
+
+
 if __name__ == '__main__':
     uvicorn.run('run:app', host='0.0.0.0', port=8000,
                 reload=True, debug=True, workers=1)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = '__Jack__'
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from fastapi import Depends, FastAPI, HTTPException
+
+from tutorial import chapter06
+
+"""
+Benchmark 第六章的性能基准测试（不是pytest用例,在项目根目录下直接运行）:
+    python -m tutorial.bench_chapter06 users_me [--requests 5000]
+"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float("nan")
+
+
+def build_app():
+    "挂载app06,再加两个对照组接口,重现之前每个请求构造/校验Pydantic用户模型的写法"
+    app = FastAPI()
+    app.include_router(chapter06.app06, prefix="/chapter06")
+
+    def decode_user(token: str = Depends(chapter06.oauth2_scheme_jwt)):
+        "对照组一: 最初的写法,每个请求jwt.decode并构造UserInDB_jwt"
+        claims = chapter06.jwt.decode(token, chapter06.JWT_KEY, algorithms=chapter06.JWT_ALGORITHMS)
+        return chapter06.UserInDB_jwt(**chapter06.fake_users_db_jwt[claims["sub"]])
+
+    def cached_user(token: str = Depends(chapter06.oauth2_scheme_jwt)):
+        "对照组二: token校验有缓存,但依赖链传递UserInDB_jwt,返回时按response_model再校验一次"
+        username = chapter06.token_verifier_jwt.verify(token).username
+        return chapter06.user_store_jwt.get(username)
+
+    # 和get_current_activate_user_jwt一样多一层依赖,两个对照组的依赖链和app06中的相同
+    def decode_activate_user(user=Depends(decode_user)):
+        if not user.activate:
+            raise HTTPException(status_code=401, detail="用户未激活")
+        return user
+
+    def cached_activate_user(user=Depends(cached_user)):
+        return decode_activate_user(user)
+
+    @app.get("/baseline/decode/users/me", response_model=chapter06.User_jwt)
+    def decode_users_me(user=Depends(decode_activate_user)):
+        return user
+
+    @app.get("/baseline/cached/users/me", response_model=chapter06.User_jwt)
+    def cached_users_me(user=Depends(cached_activate_user)):
+        return user
+
+    return app
+
+
+async def call(app, path: str, headers):
+    "不经过网络,直接以ASGI方式调用app,只测量框架和接口本身"
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "", "query_string": b"", "headers": headers,
+             "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80)}
+    statuses = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    await app(scope, receive, send)
+    assert statuses == [200], statuses
+
+
+async def measure(app, path, headers, requests: int):
+    "返回(每个请求的耗时列表, 每个请求平均的内存分配峰值字节数)"
+    for _ in range(100):  # 预热,填充token缓存
+        await call(app, path, headers)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        await call(app, path, headers)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    peaks = 0
+    samples = min(requests, 500)
+    for _ in range(samples):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await call(app, path, headers)
+        peaks += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return latencies, peaks / samples
+
+
+def bench_users_me(args):
+    app = build_app()
+    token = chapter06.jwt.encode({"sub": "jia", "exp": int(time.time()) + 3600, "iat": int(time.time())},
+                                 chapter06.JWT_KEY, algorithm=chapter06.JWT_ALGORITHMS)
+    headers = [(b"authorization", f"Bearer {token}".encode())]
+    paths = {"decode + UserInDB_jwt": "/baseline/decode/users/me",
+             "cached UserInDB_jwt": "/baseline/cached/users/me",
+             "AuthPrincipal": "/chapter06/jwt/users/me"}
+    loop = asyncio.new_event_loop()
+    print(f"GET /jwt/users/me, {args.requests} sequential in-process requests")
+    for name, path in paths.items():
+        latencies, allocated = loop.run_until_complete(measure(app, path, headers, args.requests))
+        print(f"{name:>22}: p50 {percentile(latencies, 0.5) * 1e6:6.0f}us p99 {percentile(latencies, 0.99) * 1e6:6.0f}us, "
+              f"{args.requests / sum(latencies):7.0f} req/s, peak alloc {allocated / 1024:5.1f} KiB/request")
+    loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="第六章的性能基准测试")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    users_me = subparsers.add_parser("users_me", help="每个请求构造Pydantic用户模型 vs 共享的AuthPrincipal")
+    users_me.add_argument("--requests", type=int, default=5000)
+    users_me.set_defaults(func=bench_users_me)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
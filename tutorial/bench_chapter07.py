@@ -0,0 +1,564 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = '__Jack__'
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+
+"""
+Benchmark 第七章的性能基准测试（不是pytest用例,在项目根目录下直接运行）:
+    python -m tutorial.bench_chapter07 stream_json [--provinces 300 --days 1000]
+    python -m tutorial.bench_chapter07 concurrency [--seconds 3 --latency-ms 10]
+    python -m tutorial.bench_chapter07 contention [--readers 4 --seconds 5]
+    python -m tutorial.bench_chapter07 serialize [--provinces 10 --days 1000 --repeat 20]
+    python -m tutorial.bench_chapter07 export [--provinces 100 --days 1000]
+    python -m tutorial.bench_chapter07 ingest [--provinces 10 --days 1000]
+    python -m tutorial.bench_chapter07 home [--rows 500 --repeat 200]
+"""
+
+
+def synthetic_locations(provinces: int, days: int):
+    "构造provinces个省份、每个省份days天的上游(JHU)格式数据"
+    dates = [f"{date(2020, 1, 22) + timedelta(days=i)}T00:00:00Z" for i in range(days)]
+    for i in range(provinces):
+        yield {
+            "id": i,
+            "country": "China",
+            "country_code": "CN",
+            "country_population": 1400000000,
+            "province": f"province-{i}",
+            "timelines": {
+                "confirmed": {"latest": days, "timeline": {d: n for n, d in enumerate(dates)}},
+                "deaths": {"latest": 0, "timeline": {d: 0 for d in dates}},
+                "recovered": {"latest": 0, "timeline": {}},
+            },
+        }
+
+
+def write_payload(path: str, provinces: int, days: int):
+    "逐个location写出文件,生成payload本身不占用大量内存"
+    with open(path, "w") as f:
+        f.write('{"latest": {"confirmed": 0, "deaths": 0, "recovered": 0}, "locations": [')
+        for i, location in enumerate(synthetic_locations(provinces, days)):
+            f.write(("," if i else "") + json.dumps(location))
+        f.write("]}")
+
+
+def run_child(argv):
+    "在子进程中运行一次测量,这样每种方式的峰值RSS互不影响"
+    output = subprocess.run([sys.executable, "-m", "tutorial.bench_chapter07"] + argv,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def child_stream_json(args):
+    from tutorial import chapter07
+
+    start = time.perf_counter()
+    with open(args.payload, "rb") as f:
+        if args.child == "json":
+            # 原来的方式: 整份文档一次性解析成Python对象
+            locations = json.loads(f.read())["locations"]
+        else:
+            chunks = iter(lambda: f.read(chapter07.UPSTREAM_CHUNK_SIZE), b"")
+            locations = chapter07.upstream_py_iter_json_array(chunks, "locations")
+        rows = sum(1 for i, location in enumerate(locations)
+                   for _ in chapter07.crud_py_iter_timeline_rows(location, i))
+    seconds = time.perf_counter() - start
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"rows": rows, "seconds": seconds, "max_rss_kb": max_rss_kb}))
+
+
+def bench_stream_json(args):
+    if args.child:
+        return child_stream_json(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        payload = os.path.join(tmp, "locations.json")
+        write_payload(payload, args.provinces, args.days)
+        size_mb = os.path.getsize(payload) / 1024 / 1024
+        print(f"payload: {args.provinces} provinces x {args.days} days, {size_mb:.1f} MiB")
+        for mode in ("json", "stream"):
+            result = run_child(["stream_json", "--child", mode, "--payload", payload])
+            print(f"{mode:>8}: {result['rows']} rows, {result['seconds']:.2f}s, "
+                  f"peak RSS {result['max_rss_kb'] / 1024:.1f} MiB")
+
+
+def seeded_session_factory(directory: str, provinces: int, days: int, profile: str = "dev"):
+    "在directory下按profile建一个临时sqlite数据库,写入provinces个省份、每个省份days天的数据,返回sessionmaker"
+    from sqlalchemy.orm import sessionmaker
+    from tutorial import chapter07
+
+    engine = chapter07.database_py_create_engine(f"sqlite:///{os.path.join(directory, 'bench.sqlite3')}", profile)
+    engine.echo = False  # 两种配置都不打印SQL,只比较数据库本身的配置
+    chapter07.database_py_Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    locations = list(synthetic_locations(provinces, days))
+    db = session_factory()
+    try:
+        chapter07.crud_py_reload_coronavirus_data(db, [{
+            "province_name": location["province"],
+            "country_name": location["country"],
+            "country_code": "CN",
+            "country_population": location["country_population"],
+        } for location in locations], locations)
+    finally:
+        db.close()
+    return session_factory
+
+
+def serve_in_thread(app):
+    "在后台线程中用uvicorn启动app,返回(base_url, server)"
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}", server
+
+
+def measure_throughput(url: str, clients: int, seconds: float):
+    "clients个客户端线程在seconds秒内循环请求url,返回每秒完成的请求数"
+    deadline = time.perf_counter() + seconds
+    counts = [0] * clients
+
+    def worker(i):
+        with requests.Session() as session:
+            while time.perf_counter() < deadline:
+                session.get(url).raise_for_status()
+                counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def bench_concurrency(args):
+    from fastapi import Depends, FastAPI
+    from sqlalchemy import event
+    from tutorial import chapter07
+
+    logging_off()
+    chapter07.cache_py_response_cache.maxsize = 0  # 关闭响应缓存,每个请求都要查询数据库
+    with tempfile.TemporaryDirectory() as tmp:
+        session_factory = seeded_session_factory(tmp, args.provinces, args.days)
+        if args.latency_ms:
+            # 模拟每条SQL的I/O延迟(网络数据库的往返、磁盘等待),sleep期间和真实I/O一样会释放GIL
+            event.listen(session_factory.kw["bind"], "before_cursor_execute",
+                         lambda *_: time.sleep(args.latency_ms / 1000))
+
+        def get_bench_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(chapter07.app07, prefix="/chapter07")
+        app.dependency_overrides[chapter07.get_db] = get_bench_db
+
+        @app.get("/blocking/get_data")
+        async def blocking_get_data(offset: int = 0, limit: int = 10, db=Depends(chapter07.get_db)):
+            "对照组: 原来的写法,在async def中直接执行同步的SQLAlchemy查询"
+            return chapter07.crud_py_get_data(db, None, offset, limit)
+
+        base_url, server = serve_in_thread(app)
+        try:
+            paths = {"async def (blocking)": "/blocking/get_data",
+                     "def (threadpool)": "/chapter07/appstore/covid19/get_data"}
+            print(f"GET get_data, {args.latency_ms}ms simulated latency per statement, {args.seconds}s per run")
+            for name, path in paths.items():
+                results = [f"{clients} clients {measure_throughput(base_url + path, clients, args.seconds):6.1f} req/s"
+                           for clients in (1, 2, 4, 8, 16)]
+                print(f"{name:>22}: " + ", ".join(results))
+        finally:
+            server.should_exit = True
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float("nan")
+
+
+def bench_contention(args):
+    from tutorial import chapter07
+
+    logging_off()
+    print(f"{args.readers} readers + 1 writer over {args.provinces * args.days} rows, {args.seconds}s per profile")
+    for profile in ("dev", "prod"):
+        with tempfile.TemporaryDirectory() as tmp:
+            session_factory = seeded_session_factory(tmp, args.provinces, args.days, profile)
+            deadline = time.perf_counter() + args.seconds
+            latencies, errors, writes = [], [], [0]
+
+            def writer():
+                "模拟同步任务: 反复在一个事务中更新一整个省份的数据"
+                db = session_factory()
+                version = 0
+                try:
+                    while time.perf_counter() < deadline:
+                        version += 1
+                        rows = db.query(chapter07.models_py_Data.id).filter(
+                            chapter07.models_py_Data.province_id == version % args.provinces + 1).all()
+                        db.bulk_update_mappings(chapter07.models_py_Data, [
+                            {"id": id_, "cure_num": version} for id_, in rows])
+                        db.commit()
+                        writes[0] += 1
+                finally:
+                    db.close()
+
+            def reader(i):
+                "模拟API读请求: 按省份名取回该省份的一页数据"
+                while time.perf_counter() < deadline:
+                    db = session_factory()
+                    start = time.perf_counter()
+                    try:
+                        chapter07.crud_py_get_data_page(db, province_name=f"province-{i % args.provinces}")
+                        latencies.append(time.perf_counter() - start)
+                    except Exception as e:  # 比如 database is locked
+                        errors.append(e)
+                    finally:
+                        db.close()
+
+            threads = [threading.Thread(target=writer)] + [
+                threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            print(f"{profile:>5}: reads {len(latencies) / args.seconds:7.1f}/s "
+                  f"p50 {percentile(latencies, 0.5) * 1000:6.1f}ms p99 {percentile(latencies, 0.99) * 1000:7.1f}ms, "
+                  f"read errors {len(errors)}, write txns {writes[0] / args.seconds:5.1f}/s")
+
+
+async def call(app, path: str, query_string: bytes = b"", method: str = "GET", body: bytes = b""):
+    "不经过网络,直接以ASGI方式调用app,返回响应体"
+    headers = [(b"host", b"bench")]
+    if body:
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    scope = {"type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "", "query_string": query_string, "headers": headers,
+             "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80)}
+    chunks = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(chunks)
+
+
+def bench_serialize(args):
+    from fastapi import Depends, FastAPI
+    from tutorial import chapter07
+
+    logging_off()
+    chapter07.cache_py_response_cache.maxsize = 0  # 关闭响应缓存,每次都完整地查询和序列化
+    rows = args.provinces * args.days
+    with tempfile.TemporaryDirectory() as tmp:
+        session_factory = seeded_session_factory(tmp, args.provinces, args.days)
+
+        def get_bench_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(chapter07.app07, prefix="/chapter07")
+        app.dependency_overrides[chapter07.get_db] = get_bench_db
+        app.dependency_overrides[chapter07.get_user_agent] = lambda: None  # 不打印User-Agent
+
+        @app.get("/baseline/get_data")
+        def baseline_get_data(offset: int = 0, limit: int = 10, db=Depends(chapter07.get_db)):
+            "对照组: 原来的写法,返回ORM对象,由FastAPI经jsonable_encoder和标准库json序列化"
+            return chapter07.crud_py_get_data(db, None, offset, limit)
+
+        query_string = f"limit={rows}".encode()
+        orjson = chapter07.orjson
+        runs = {"ORM + jsonable_encoder": ("/baseline/get_data", orjson),
+                "SQL rows + stdlib json": ("/chapter07/appstore/covid19/get_data", None),
+                "SQL rows + orjson": ("/chapter07/appstore/covid19/get_data", orjson)}
+        loop = asyncio.new_event_loop()
+        print(f"GET get_data?limit={rows}, {args.repeat} responses per run, CPU time (all threads) per response")
+        for name, (path, json_module) in runs.items():
+            if name.endswith("orjson") and orjson is None:
+                print(f"{name:>24}: skipped, orjson is not installed")
+                continue
+            chapter07.orjson = json_module
+            body = loop.run_until_complete(call(app, path, query_string))  # 预热
+            assert len(json.loads(body)) == rows
+            cpu, wall = time.process_time(), time.perf_counter()
+            for _ in range(args.repeat):
+                loop.run_until_complete(call(app, path, query_string))
+            cpu, wall = (time.process_time() - cpu) / args.repeat, (time.perf_counter() - wall) / args.repeat
+            print(f"{name:>24}: CPU {cpu * 1000:7.1f}ms, wall {wall * 1000:7.1f}ms, body {len(body) / 1024:6.0f} KiB")
+        chapter07.orjson = orjson
+        loop.close()
+
+
+def child_export(args):
+    from sqlalchemy.orm import sessionmaker
+    from fastapi import FastAPI
+    from tutorial import chapter07
+
+    logging_off()
+    chapter07.cache_py_response_cache.maxsize = 0
+    engine = chapter07.database_py_create_engine(f"sqlite:///{args.database}", "dev")
+    engine.echo = False
+    session_factory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+    def get_bench_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+    app.include_router(chapter07.app07, prefix="/chapter07")
+    app.dependency_overrides[chapter07.get_db] = get_bench_db
+    app.dependency_overrides[chapter07.get_session_factory] = lambda: session_factory
+    app.dependency_overrides[chapter07.get_user_agent] = lambda: None
+    base_url, server = serve_in_thread(app)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if args.child == "get_data":
+        url = f"{base_url}/chapter07/appstore/covid19/get_data?limit={args.provinces * args.days}"
+    else:
+        url = f"{base_url}/chapter07/appstore/covid19/export?format={args.child}"
+    start = time.perf_counter()
+    first_byte, size = None, 0
+    with requests.get(url, stream=True) as response, open(args.output, "wb") as f:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=None):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+            f.write(chunk)
+    seconds = time.perf_counter() - start
+    server.should_exit = True
+    rss_growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    print(json.dumps({"first_byte": first_byte, "seconds": seconds, "bytes": size, "rss_growth_kb": rss_growth_kb}))
+
+
+def bench_ingest(args):
+    from fastapi import FastAPI
+    from tutorial import chapter07
+
+    logging_off()
+    with tempfile.TemporaryDirectory() as tmp:
+        # 每个省份先有1天的数据,回填之后的args.days天
+        session_factory = seeded_session_factory(tmp, args.provinces, 1, "prod")
+
+        def get_bench_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(chapter07.app07, prefix="/chapter07")
+        app.dependency_overrides[chapter07.get_db] = get_bench_db
+        app.dependency_overrides[chapter07.get_user_agent] = lambda: None
+        loop = asyncio.new_event_loop()
+        items = [{"province_name": f"province-{i}", "date": str(date(2020, 1, 23) + timedelta(days=d)),
+                  "confirm_num": d, "death_num": 0, "cure_num": 0}
+                 for i in range(args.provinces) for d in range(args.days)]
+        print(f"backfill {len(items)} data points over {args.provinces} provinces, in-process ASGI calls")
+
+        # 对照组: 每条数据一个create_data请求,只测前args.single条再按比例估算
+        start = time.perf_counter()
+        for item in items[:args.single]:
+            province_name = item.pop("province_name")
+            loop.run_until_complete(call(app, "/chapter07/appstore/covid19/create_data",
+                                         f"province_name={province_name}".encode(), "POST", json.dumps(item).encode()))
+            item["province_name"] = province_name
+        single = (time.perf_counter() - start) / args.single
+        print(f"  create_data x1: {single * 1000:6.2f}ms per item, ~{single * len(items):6.1f}s for all items")
+
+        start = time.perf_counter()
+        result = json.loads(loop.run_until_complete(call(
+            app, "/chapter07/appstore/covid19/create_data/batch", method="POST", body=json.dumps(items).encode())))
+        seconds = time.perf_counter() - start
+        assert result["inserted"] == len(items) - args.single, result["errors"][:3]
+        print(f"    create_data/batch: {seconds / len(items) * 1000:6.3f}ms per item, {seconds:6.2f}s for all items")
+        loop.close()
+
+
+def bench_home(args):
+    from fastapi import FastAPI
+    from fastapi.staticfiles import StaticFiles
+    from tutorial import chapter07
+
+    logging_off()
+    with tempfile.TemporaryDirectory() as tmp:
+        session_factory = seeded_session_factory(tmp, args.provinces, args.days)
+
+        def get_bench_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.mount(path="/static", app=StaticFiles(directory="./tutorial/static"), name="static")
+        app.include_router(chapter07.app07, prefix="/chapter07")
+        app.dependency_overrides[chapter07.get_db] = get_bench_db
+        app.dependency_overrides[chapter07.get_user_agent] = lambda: None
+        path, query_string = "/chapter07/appstore/covid19/", f"limit={args.rows}".encode()
+        runs = {"full render": (chapter07.cache_py_response_cache.clear, chapter07.cache_py_fragment_cache.clear,
+                                chapter07.templates.clear),
+                "fragment cache hit": (chapter07.cache_py_response_cache.clear,),
+                "response cache hit": ()}
+        loop = asyncio.new_event_loop()
+        print(f"GET covid19/?limit={args.rows}, {args.repeat} requests per run, in-process ASGI calls")
+        for name, clears in runs.items():
+            body = loop.run_until_complete(call(app, path, query_string))  # 预热
+            assert body.count(b"<tr>") == args.rows + 1
+            elapsed = 0
+            for _ in range(args.repeat):
+                for clear in clears:
+                    clear()
+                start = time.perf_counter()
+                loop.run_until_complete(call(app, path, query_string))
+                elapsed += time.perf_counter() - start
+            print(f"{name:>20}: {elapsed / args.repeat * 1e6:8.0f}us per request")
+        loop.close()
+
+
+def parse_export(mode: str, path: str):
+    "客户端解析下载的数据(读成按列的数据),返回行数"
+    with open(path, "rb") as f:
+        if mode == "get_data":
+            return len(json.load(f))
+        if mode == "ndjson":
+            return sum(1 for line in f if json.loads(line))
+        if mode == "csv":
+            import csv
+            return sum(1 for _ in csv.reader(line.decode() for line in f)) - 1
+        import pyarrow
+        return pyarrow.ipc.open_stream(f).read_all().num_rows
+
+
+def bench_export(args):
+    if args.child:
+        return child_export(args)
+    logging_off()
+    try:
+        import pyarrow  # noqa: F401
+        modes = ("get_data", "ndjson", "csv", "arrow")
+    except ImportError:
+        print("pyarrow is not installed, skipping arrow")
+        modes = ("get_data", "ndjson", "csv")
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded_session_factory(tmp, args.provinces, args.days)
+        database = os.path.join(tmp, "bench.sqlite3")
+        print(f"{args.provinces * args.days} rows; peak RSS growth is measured in a fresh process per mode")
+        for mode in modes:
+            output = os.path.join(tmp, f"export.{mode}")
+            result = run_child(["export", "--child", mode, "--database", database, "--output", output,
+                                "--provinces", str(args.provinces), "--days", str(args.days)])
+            start = time.perf_counter()
+            rows = parse_export(mode, output)
+            parse_seconds = time.perf_counter() - start
+            assert rows == args.provinces * args.days, rows
+            print(f"{mode:>9}: first byte {result['first_byte'] * 1000:7.1f}ms, total {result['seconds']:5.2f}s, "
+                  f"{result['bytes'] / 1024 / 1024:5.1f} MiB, parse {parse_seconds:5.2f}s, "
+                  f"peak RSS growth {result['rss_growth_kb'] / 1024:6.1f} MiB")
+
+
+def logging_off():
+    "关闭SQLAlchemy的echo日志,避免打印语句影响测量"
+    import logging
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+    logging.getLogger("tutorial.chapter07").setLevel(logging.ERROR)  # 写入测试数据时的慢查询日志
+    from tutorial import chapter07
+    chapter07.database_py_engine.echo = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="第七章的性能基准测试")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    stream_json = subparsers.add_parser("stream_json", help="json.loads整份文档 vs 流式解析timelines")
+    stream_json.add_argument("--provinces", type=int, default=300)
+    stream_json.add_argument("--days", type=int, default=1000)
+    stream_json.add_argument("--child", choices=("json", "stream"), help=argparse.SUPPRESS)
+    stream_json.add_argument("--payload", help=argparse.SUPPRESS)
+    stream_json.set_defaults(func=bench_stream_json)
+
+    concurrency = subparsers.add_parser("concurrency", help="async def中阻塞查询 vs def接口(线程池)的并发吞吐量")
+    concurrency.add_argument("--provinces", type=int, default=30)
+    concurrency.add_argument("--days", type=int, default=300)
+    concurrency.add_argument("--seconds", type=float, default=3)
+    concurrency.add_argument("--latency-ms", type=float, default=10, help="模拟每条SQL的I/O延迟,0表示不模拟")
+    concurrency.set_defaults(func=bench_concurrency)
+
+    contention = subparsers.add_parser("contention", help="dev和prod数据库配置下的读写竞争")
+    contention.add_argument("--provinces", type=int, default=30)
+    contention.add_argument("--days", type=int, default=1000)
+    contention.add_argument("--readers", type=int, default=4)
+    contention.add_argument("--seconds", type=float, default=5)
+    contention.set_defaults(func=bench_contention)
+
+    serialize = subparsers.add_parser("serialize", help="大列表响应: ORM+jsonable_encoder vs SQL元组+快速JSON响应")
+    serialize.add_argument("--provinces", type=int, default=10)
+    serialize.add_argument("--days", type=int, default=1000)
+    serialize.add_argument("--repeat", type=int, default=20)
+    serialize.set_defaults(func=bench_serialize)
+
+    export = subparsers.add_parser("export", help="get_data一次性返回全部数据 vs 流式导出(NDJSON/CSV/Arrow)的首字节时间、大小和内存")
+    export.add_argument("--provinces", type=int, default=100)
+    export.add_argument("--days", type=int, default=1000)
+    export.add_argument("--child", choices=("get_data", "ndjson", "csv", "arrow"), help=argparse.SUPPRESS)
+    export.add_argument("--database", help=argparse.SUPPRESS)
+    export.add_argument("--output", help=argparse.SUPPRESS)
+    export.set_defaults(func=bench_export)
+
+    ingest = subparsers.add_parser("ingest", help="逐条create_data vs create_data/batch回填数据")
+    ingest.add_argument("--provinces", type=int, default=10)
+    ingest.add_argument("--days", type=int, default=1000)
+    ingest.add_argument("--single", type=int, default=200, help="对照组实际发送的单条请求数")
+    ingest.set_defaults(func=bench_ingest)
+
+    home = subparsers.add_parser("home", help="covid19首页: 完整渲染 vs 表格片段缓存 vs 响应缓存")
+    home.add_argument("--provinces", type=int, default=10)
+    home.add_argument("--days", type=int, default=100)
+    home.add_argument("--rows", type=int, default=500)
+    home.add_argument("--repeat", type=int, default=200)
+    home.set_defaults(func=bench_home)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
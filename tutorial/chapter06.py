@@ -5,14 +5,25 @@
 from pydantic import EmailStr
 from fastapi.security import OAuth2PasswordBearer  # Bearer令牌
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Iterable, NamedTuple, Optional
+from abc import ABC, abstractmethod
 from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import os
+import threading
+import time
 
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext  # .hash()生成哈希,.verity()验证哈希
 from pydantic import BaseModel
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, create_engine, select
 
 app06 = APIRouter()
 
@@ -75,6 +86,181 @@ class UserInDB(User):
     hashed_password: str
 
 
+"""
+用户存储
+认证只依赖下面的接口(get/add/bulk_import),不直接读模块级的字典,后端由环境变量CHAPTER06_USER_STORE选择:
+    memory(默认): 进程内字典,用户模型在写入时构造一次,读取时直接返回;
+    SQLAlchemy数据库URL(如sqlite:///./users.sqlite3): 用户表的username有唯一索引,再加一层进程内的读穿透(read-through)LRU缓存,
+        用户数增长到百万级时,未命中缓存的查询也只是一次索引查找,认证延迟基本不变。
+"""
+USER_STORE_URL = os.getenv("CHAPTER06_USER_STORE", "memory")
+USER_CACHE_SIZE = 10000  # 最多缓存的用户个数
+USER_CACHE_TTL = 60  # 秒,其它进程修改的用户最多在这么久之后可见
+USER_IMPORT_CHUNK_SIZE = 1000
+
+
+class UserStore(ABC):
+    """用户存储接口, model是读取时返回的Pydantic用户模型(如UserInDB)
+    on_change(usernames)在新增/覆盖用户之后调用,用来让其它地方缓存的用户数据(如jwt-token校验器)失效。
+    """
+
+    def __init__(self, model, on_change=None):
+        self.model = model
+        self.on_change = on_change
+
+    def changed(self, usernames):
+        if self.on_change is not None and usernames:
+            self.on_change(usernames)
+
+    @abstractmethod
+    def get(self, username: str):
+        "返回用户模型,不存在时返回None"
+
+    def add(self, user: dict):
+        "新增或覆盖一个用户"
+        self.bulk_import([user])
+
+    @abstractmethod
+    def bulk_import(self, users: Iterable[dict]) -> int:
+        "批量导入用户,返回导入的个数"
+
+
+class InMemoryUserStore(UserStore):
+    """进程内字典实现: username -> 用户模型"""
+
+    def __init__(self, model, users: Iterable[dict] = ()):
+        super().__init__(model)
+        self._users = {}
+        self.bulk_import(users)
+
+    def get(self, username: str):
+        return self._users.get(username)
+
+    def bulk_import(self, users: Iterable[dict]) -> int:
+        usernames = []
+        for user in users:
+            user = self.model(**user)
+            self._users[user.username] = user
+            usernames.append(user.username)
+        self.changed(usernames)
+        return len(usernames)
+
+
+class SqlUserStore(UserStore):
+    """SQLAlchemy实现: username上有唯一索引的用户表 + 进程内的LRU/TTL读穿透缓存"""
+
+    def __init__(self, engine, model, table_name: str = "users",
+                 cache_size: int = USER_CACHE_SIZE, cache_ttl: float = USER_CACHE_TTL, clock=time.monotonic):
+        super().__init__(model)
+        self.engine = engine
+        self.table = Table(
+            table_name, MetaData(),
+            Column("id", Integer, primary_key=True),
+            Column("username", String(64), nullable=False, unique=True, index=True),
+            Column("email", String(128), nullable=False),
+            Column("gender", String(16), nullable=False),
+            Column("hashed_password", String(128), nullable=False),
+            Column("activate", Boolean, nullable=False, default=True),
+        )
+        self.table.create(bind=engine, checkfirst=True)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._clock = clock
+        self._cache = OrderedDict()  # username -> (用户模型, 过期时间)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username: str):
+        with self._lock:
+            entry = self._cache.get(username)
+            if entry is not None and entry[1] > self._clock():
+                self._cache.move_to_end(username)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        columns = [c for c in self.table.c if c.name != "id"]
+        with self.engine.connect() as conn:
+            row = conn.execute(select(columns).where(self.table.c.username == username)).first()
+        if row is None:
+            return None
+        user = self.model(**dict(row))
+        with self._lock:
+            self._cache[username] = (user, self._clock() + self.cache_ttl)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return user
+
+    def bulk_import(self, users: Iterable[dict], chunk_size: int = USER_IMPORT_CHUNK_SIZE) -> int:
+        """分块executemany插入,整个导入在一个事务中;已存在的用户名先删除再插入(即覆盖)"""
+        usernames = []
+        with self.engine.begin() as conn:
+            chunk = []
+            for user in users:
+                chunk.append(self.model(**user).dict())  # 导入前按模型校验
+                if len(chunk) >= chunk_size:
+                    usernames += self._insert(conn, chunk)
+                    chunk = []
+            if chunk:
+                usernames += self._insert(conn, chunk)
+        self.changed(usernames)  # 事务提交之后再通知
+        return len(usernames)
+
+    def _insert(self, conn, rows):
+        usernames = [row["username"] for row in rows]
+        conn.execute(self.table.delete().where(self.table.c.username.in_(usernames)))
+        conn.execute(self.table.insert(), rows)
+        with self._lock:
+            for username in usernames:
+                self._cache.pop(username, None)
+        return usernames
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache), "maxsize": self.cache_size}
+
+
+def create_user_store(model, users: Iterable[dict], table_name: str, url: str = USER_STORE_URL, on_change=None):
+    """按url创建用户存储,并写入users中还不存在的用户;之后对用户的修改会调用on_change(usernames)"""
+    if url == "memory":
+        store = InMemoryUserStore(model, users)
+    else:
+        connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+        store = SqlUserStore(create_engine(url, connect_args=connect_args), model, table_name)
+        # 先查出还不存在的用户再导入: 不能在bulk_import的写事务进行中再用另一个连接查询
+        missing = [user for user in users if store.get(user["username"]) is None]
+        store.bulk_import(missing)
+    store.on_change = on_change  # 初始数据写入时还没有需要失效的缓存
+    return store
+
+
+user_store = create_user_store(UserInDB, fake_users_db.values(), table_name="users")
+
+
+class AuthPrincipal(NamedTuple):
+    """认证通过的当前用户(principal)
+    依赖链(get_current_user -> user_is_activate -> user_is_me)中传递的是这个不可变、无__dict__的轻量对象,
+    每个请求只构造一次、不做Pydantic校验,也不携带哈希密码;只在路由返回时(to_response)转换为响应。
+    """
+    username: str
+    email: str
+    gender: Gender
+    activate: bool
+
+    @classmethod
+    def from_user(cls, user):
+        "由用户存储返回的用户模型(UserInDB/UserInDB_jwt)构造"
+        return cls(user.username, user.email, user.gender, user.activate)
+
+    def to_response(self):
+        """转换为User/User_jwt格式的JSON响应
+        数据在写入用户存储时已经校验过,直接返回JSONResponse,跳过FastAPI按response_model的再次校验和序列化
+        """
+        return JSONResponse({"username": self.username, "email": self.email,
+                             "gender": self.gender.value, "activate": self.activate})
+
+
 def fake_token_encode(user: UserInDB):
     token = user.username + "_token"
     return token
@@ -82,14 +268,13 @@ def fake_token_encode(user: UserInDB):
 
 def fake_token_decode(token: str):
     username = token[:-len("_token")]
-    user = fake_users_db.get(username)
-    if user is not None:
-        return UserInDB(**user)  # 创建为Pydantic模型
-    return None
+    return user_store.get(username)  # 用户不存在时为None
 
 
+# NOTE 用户存储可能是数据库(SqlUserStore),缓存未命中时user_store.get是阻塞查询:
+#   读取用户的接口和依赖用def声明,由FastAPI放到线程池中执行;必须是async def的接口用run_in_threadpool调用
 @app06.post(path="/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+def login(form_data: OAuth2PasswordRequestForm = Depends()):
     """
     登陆模块：客户端填写登陆表单并进行用户验证，成功则创建token作为响应体,并向指定url发送该响应体。
     OAuth2PasswordRequestForm 是一个类依赖项，声明了如下的请求表单：
@@ -106,10 +291,9 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     # 表单验证并返回token
     username = form_data.username
     password = form_data.password
-    user = fake_users_db.get(username)
+    user = user_store.get(username)
     if user is None:
         raise http_exception
-    user = UserInDB(**user)  # 创建为Pydantic模型
     if user.hashed_password != fake_hashed_password(password):
         raise http_exception
     token = fake_token_encode(user)
@@ -123,7 +307,7 @@ oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/chapter06/token", scheme_name="scheme name by jia", description="desc by jia")
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def get_current_user(token: str = Depends(oauth2_scheme)):
     # 嵌套依赖 # 获取当前用户
     user = fake_token_decode(token)
     if user is None:
@@ -133,10 +317,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             # OAuth2的规范，如果认证失败，请求头中返回“WWW-Authenticate”
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return user
+    return AuthPrincipal.from_user(user)
 
 
-async def user_is_activate(user: UserInDB = Depends(get_current_user)):
+async def user_is_activate(user: AuthPrincipal = Depends(get_current_user)):
     # 嵌套依赖 # 验证用户是否激活
     if not user.activate:
         raise HTTPException(
@@ -144,10 +328,10 @@ async def user_is_activate(user: UserInDB = Depends(get_current_user)):
     return user
 
 
-@app06.get("/users/me")
-async def user_is_me(user: UserInDB = Depends(user_is_activate)):
+@app06.get("/users/me", response_model=User)
+async def user_is_me(user: AuthPrincipal = Depends(user_is_activate)):
     # 嵌套依赖 # 激活用户可进行的一系列操作
-    return user
+    return user.to_response()
 
 
 """方式二: JWT-token的OAuth2 认证
@@ -172,9 +356,12 @@ async def user_is_me(user: UserInDB = Depends(user_is_activate)):
 # 这里token来源于依赖OAuth2PasswordRequestForm的登陆模块，所以tokenUrl务必和登陆模块的url一致(指在浏览器中的实际url)。
 oauth2_scheme_jwt = OAuth2PasswordBearer(tokenUrl="/chapter06/jwt/token")
 # 该模块帮助使用多种算法对密码进行哈希和验证。
+# BCRYPT_ROUNDS是bcrypt的成本因子,每+1哈希和验证的耗时翻倍;只影响新生成的哈希,已有哈希按其自身的rounds验证。
+BCRYPT_ROUNDS = int(os.getenv("CHAPTER06_BCRYPT_ROUNDS", "12"))
 secret_context = CryptContext(
     # 下面列出你希望支持的hash算法。默认是bcrypt算法，如果报错的话试一试安装pip install passlib[bcrypt]
     schemes=["bcrypt", "pbkdf2_sha256", "des_crypt"],
+    bcrypt__rounds=BCRYPT_ROUNDS,
     # Automatically mark all but first hasher in list as deprecated.
     # (this will be the default in Passlib 2.0)
     # deprecated="auto",
@@ -196,14 +383,70 @@ def verify_hashed_secret(plain_secret: str, hashed_secret: str):
     return secret_context.verify(secret=plain_secret, hash=hashed_secret)
 
 
+# bcrypt故意设计得很慢(12 rounds约几百毫秒),在async def中直接调用会阻塞事件循环,期间所有请求都得不到处理。
+# 所以哈希和验证交给专用的、大小有限的线程池执行(bcrypt计算时会释放GIL);
+# 排队的任务也有上限,满了就直接返回429,登录高峰时只有登录变慢,而不会拖垮整个API。
+SECRET_HASH_WORKERS = int(os.getenv("CHAPTER06_SECRET_HASH_WORKERS", "2"))
+SECRET_HASH_QUEUE = int(os.getenv("CHAPTER06_SECRET_HASH_QUEUE", "32"))
+
+
+class SecretHasher_jwt:
+    """在有界线程池中执行密码哈希和验证
+    同时在执行和排队的任务最多workers+queue个,超出时抛出429 HTTPException。
+    """
+
+    def __init__(self, workers: int = SECRET_HASH_WORKERS, queue: int = SECRET_HASH_QUEUE):
+        self.capacity = workers + queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="secret-hasher")
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="登录请求过多,请稍后重试",
+                headers={"Retry-After": "1"},
+            )
+        with self._lock:
+            self.in_flight += 1
+        future = self._executor.submit(fn, *args)
+        # 请求被取消时线程中的任务仍会执行完,所以在任务结束时(而不是await结束时)才释放名额
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    async def hash(self, plain_secret: str):
+        return await self._run(gen_hashed_secret, plain_secret)
+
+    async def verify(self, plain_secret: str, hashed_secret: str):
+        return await self._run(verify_hashed_secret, plain_secret, hashed_secret)
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": self.in_flight, "rejected": self.rejected, "capacity": self.capacity}
+
+
+secret_hasher_jwt = SecretHasher_jwt()
+
+
 # 模拟数据库中的数据
 fake_users_db_jwt = {
     "jia": {
         "username": "jia",
         "email": "jia@example.com",
         "gender": Gender.male,
-        # 数据库中要保持哈希密码
-        "hashed_password": gen_hashed_secret(plain_secret="jia_secret"),
+        # 数据库中要保持哈希密码。这里是预先用gen_hashed_secret(plain_secret="jia_secret")生成的,
+        # 避免每次导入模块时都做一次耗时的bcrypt哈希
+        "hashed_password": "$2b$12$914H4PSU2H/hzgyJl21Szu5Ru0pT5RWIMkbXyl0b4ILu9i08BtQTK",
         "activate": True,
     },
 }
@@ -220,6 +463,15 @@ class UserInDB_jwt(User_jwt):
     hashed_password: str
 
 
+def forget_principals_jwt(usernames):
+    "用户被修改(如禁用、重新导入)之后,丢弃token校验器中缓存的这些用户,下次请求重新从用户存储读取"
+    token_verifier_jwt.forget_users(usernames)
+
+
+user_store_jwt = create_user_store(UserInDB_jwt, fake_users_db_jwt.values(), table_name="users_jwt",
+                                   on_change=forget_principals_jwt)
+
+
 class Token_jwt(BaseModel):
     "token响应模型"
     access_token: str
@@ -238,13 +490,12 @@ async def login_for_access_token_jwt(data_form: OAuth2PasswordRequestForm = Depe
     username = data_form.username
     password = data_form.password
     # 校验用户名和密码
-    user = fake_users_db_jwt.get(username)
+    user = await run_in_threadpool(user_store_jwt.get, username)  # 查询用户存储不阻塞事件循环
     if user is None:
         raise http_exception
 
-    user = UserInDB_jwt(**user)  # 包装为用户数据库模型
-    if not verify_hashed_secret(plain_secret=password,
-                                hashed_secret=user.hashed_password):
+    # 在有界线程池中验证密码,不阻塞事件循环
+    if not await secret_hasher_jwt.verify(password, user.hashed_password):
         raise http_exception
 
     # 创建jwt-token
@@ -252,7 +503,8 @@ async def login_for_access_token_jwt(data_form: OAuth2PasswordRequestForm = Depe
     try:
         expire_time = datetime.utcnow() + timedelta(minutes=JWT_EXPIRE)  # timedelta类型
         # token过期失效是jwt自动的,不需要去额外手动实现判断.
-        access_token = jwt.encode(claims={"sub": user.username, "exp": expire_time},
+        # iat(签发时间)用于按用户撤销token: 撤销时间之前签发的token全部失效
+        access_token = jwt.encode(claims={"sub": user.username, "exp": expire_time, "iat": int(time.time())},
                                   key=JWT_KEY,
                                   algorithm=JWT_ALGORITHMS)
     except JWTError:
@@ -260,6 +512,120 @@ async def login_for_access_token_jwt(data_form: OAuth2PasswordRequestForm = Depe
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+JWT_CACHE_SIZE = 10000  # 最多缓存的token个数
+JWT_CACHE_TTL = 60  # jose不要求exp声明;没有exp的token最多缓存的秒数,之后重新校验
+
+
+class TokenVerifier_jwt:
+    """jwt-token校验器
+    jwt.decode每次都要解析header、校验HMAC签名,再由用户数据构造UserInDB_jwt;同一个token往往在有效期内被反复使用,
+    所以按token的sha256摘要缓存校验通过的结果(AuthPrincipal),直到token的exp过期,签名只在第一次请求时校验。
+        - revoke(token): 撤销一个token(如退出登录);
+        - revoke_user(username): 撤销某个用户在此之前签发的全部token,并丢弃缓存的用户模型(如修改密码、禁用用户);
+        - forget_users(usernames): 只丢弃缓存的用户模型,token仍然有效(用户存储中的用户被修改时调用);
+        - stats(): 命中、未命中、校验失败、撤销次数和缓存大小。
+    """
+
+    def __init__(self, key: str = JWT_KEY, algorithms=JWT_ALGORITHMS, maxsize: int = JWT_CACHE_SIZE, clock=time.time):
+        self.key = key
+        self.algorithms = algorithms
+        self.maxsize = maxsize
+        self._clock = clock
+        self._cache = OrderedDict()  # token摘要 -> (缓存到期时间, username, AuthPrincipal, exp)
+        self._revoked = {}  # 被撤销的token摘要 -> exp,过期之后就不需要再记住
+        self._revoked_before = {}  # username -> 撤销时间,iat早于它的token无效
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.revocations = 0
+
+    @staticmethod
+    def digest(token: str):
+        return hashlib.sha256(token.encode()).digest()
+
+    @staticmethod
+    def load_user(username: str):
+        "从用户存储取回用户,不存在时返回None"
+        return user_store_jwt.get(username)
+
+    def verify(self, token: str):
+        "校验token并返回对应的AuthPrincipal;token无效、过期、被撤销或用户不存在时抛出JWTError"
+        digest = self.digest(token)
+        now = self._clock()
+        with self._lock:
+            entry = self._cache.get(digest)
+            if entry is not None:
+                if entry[0] > now:
+                    self._cache.move_to_end(digest)
+                    self.hits += 1
+                    return entry[2]
+                del self._cache[digest]
+            self.misses += 1
+        try:
+            if digest in self._revoked:
+                raise JWTError("token has been revoked")
+            claims = jwt.decode(token=token, key=self.key, algorithms=self.algorithms)
+            username = claims.get("sub")
+            if username is None:
+                raise JWTError("token has no subject")
+            revoked_before = self._revoked_before.get(username)
+            if revoked_before is not None and claims.get("iat", 0) < revoked_before:
+                raise JWTError("token has been revoked")
+            user = self.load_user(username)
+            if user is None:
+                raise JWTError("user not found")
+        except JWTError:
+            with self._lock:
+                self.failures += 1
+            raise
+        with self._lock:
+            user = AuthPrincipal.from_user(user)
+            exp = claims.get("exp")
+            self._cache[digest] = (now + JWT_CACHE_TTL if exp is None else exp, username, user, exp)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return user
+
+    def revoke(self, token: str):
+        "撤销一个token,直到它过期之前都会被拒绝"
+        digest = self.digest(token)
+        now = self._clock()
+        with self._lock:
+            entry = self._cache.pop(digest, None)
+            # 缓存中没有时不知道exp,保守地按最长有效期记住;没有exp的token永远有效,撤销记录也一直保留
+            if entry is None:
+                self._revoked[digest] = now + JWT_EXPIRE * 60
+            else:
+                self._revoked[digest] = float("inf") if entry[3] is None else entry[3]
+            self._revoked = {d: exp for d, exp in self._revoked.items() if exp > now}
+            self.revocations += 1
+
+    def revoke_user(self, username: str):
+        "撤销某个用户到目前为止签发的全部token"
+        with self._lock:
+            # iat精确到秒,+1保证撤销这一秒内签发的token也失效
+            self._revoked_before[username] = int(self._clock()) + 1
+            for digest in [d for d, entry in self._cache.items() if entry[1] == username]:
+                del self._cache[digest]
+            self.revocations += 1
+
+    def forget_users(self, usernames):
+        "丢弃这些用户的缓存项,下次校验时重新从用户存储读取(如已被禁用)"
+        usernames = set(usernames)
+        with self._lock:
+            for digest in [d for d, entry in self._cache.items() if entry[1] in usernames]:
+                del self._cache[digest]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "failures": self.failures,
+                    "revocations": self.revocations, "size": len(self._cache), "maxsize": self.maxsize}
+
+
+token_verifier_jwt = TokenVerifier_jwt()
+
+
 def get_current_user_jwt(token: str = Depends(oauth2_scheme_jwt)):
     """
     之前依赖OAuth2PasswordRequestForm类的登陆模块返回了token响应体，
@@ -271,24 +637,13 @@ def get_current_user_jwt(token: str = Depends(oauth2_scheme_jwt)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        jwt_decode = jwt.decode(token=token,
-                                key=JWT_KEY,
-                                algorithms=JWT_ALGORITHMS)
-        username = jwt_decode.get("sub")
-        if username is None:
-            # 找不到token
-            raise credentials_exception
-    except:
-        raise credentials_exception
-
-    user = fake_users_db_jwt.get(username)
-    if user is None:
+        # 校验签名和有效期、取回用户,同一个token只在第一次请求时真正执行
+        return token_verifier_jwt.verify(token)
+    except JWTError:
         raise credentials_exception
-    user = UserInDB_jwt(**user)
-    return user
 
 
-def get_current_activate_user_jwt(user: UserInDB_jwt = Depends(get_current_user_jwt)):
+def get_current_activate_user_jwt(user: AuthPrincipal = Depends(get_current_user_jwt)):
     if not user.activate:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="用户未激活")
@@ -296,5 +651,12 @@ def get_current_activate_user_jwt(user: UserInDB_jwt = Depends(get_current_user_
 
 
 @app06.get("/jwt/users/me", response_model=User_jwt)  # 这里响应不含密码的用户数据模型
-def get_user_me_jwt(user: UserInDB_jwt = Depends(get_current_activate_user_jwt)):
-    return user
+def get_user_me_jwt(user: AuthPrincipal = Depends(get_current_activate_user_jwt)):
+    return user.to_response()
+
+
+@app06.post("/jwt/logout")
+def logout_jwt(token: str = Depends(oauth2_scheme_jwt), user: AuthPrincipal = Depends(get_current_user_jwt)):
+    """退出登录: 撤销当前的jwt-token"""
+    token_verifier_jwt.revoke(token)
+    return {"message": "已退出登录"}
@@ -2,20 +2,59 @@
 # -*- coding:utf-8 -*-
 # __author__ = '__Jack__'
 
-from fastapi import BackgroundTasks
-from pydantic import HttpUrl
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import HTTPException, status
 from sqlalchemy.orm import Session
 from fastapi.templating import Jinja2Templates
-from datetime import datetime
+import jinja2
+import base64
+import codecs
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from enum import Enum
+from datetime import datetime, timedelta
 from datetime import date as date_
-from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Date, ForeignKey, func
-from sqlalchemy.orm import sessionmaker, relationship
+from typing import Iterable, List, Optional, Tuple, Union
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Date, Float, ForeignKey, Index
+from sqlalchemy import and_, func, select, tuple_
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, contains_eager
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from fastapi import APIRouter, Depends, Request
-from pydantic import BaseModel
+from sqlalchemy import create_engine, event
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from fastapi import APIRouter, Depends, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ValidationError
+try:
+    import fcntl  # 只在类Unix系统上可用,用于定时同步的跨进程文件锁
+except ImportError:
+    fcntl = None
+try:
+    import orjson  # 可选依赖,比标准库json快得多,并且原生支持date/datetime: pip install orjson
+except ImportError:
+    orjson = None
+try:
+    import pyarrow  # 可选依赖,导出Arrow格式时需要: pip install pyarrow
+except ImportError:
+    pyarrow = None
 """
 SQLAlchemy是Python编程语言下的一款ORM框架，该框架建立在数据库API之上，使用关系对象映射进行数据库操作。
     简言之便是：将对象对应具体的数据库表，将对象的操作转换成SQL，然后使用数据API执行SQL并获取执行结果。
@@ -25,16 +64,176 @@ https://www.osgeo.cn/sqlalchemy/
 在fastapi中，对于用户级别的api设计,可以让pydantic的BaseModel实例来包装一个或多个ORM框架的对象中的全部或部分属性。
 """
 
+logger = logging.getLogger(__name__)
+
 """
 1. 建立ORM对象关系模型的初始化
 在项目结构中,下面代码可放在database.py
 """
+# 数据库url格式:'数据库类型+数据库驱动名称://用户名:口令@机器地址:端口号/数据库名'
+DATABASE_URL = os.environ.get("CHAPTER07_DATABASE_URL", "sqlite:///./tutorial/chapter07.sqlite3")
+# dev: 保持教程原来的行为(打印每条SQL);prod: 关闭echo,并为sync任务和API读请求的并发读写调优sqlite
+DATABASE_PROFILE = os.environ.get("CHAPTER07_DATABASE_PROFILE", "dev")
+
+# prod配置下每个sqlite连接建立时执行的PRAGMA
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # 写事务进行时读者仍能读到最后一次提交的数据,读写互不阻塞
+    "synchronous": "NORMAL",  # WAL模式下不会损坏数据库,只在checkpoint时fsync,掉电时最多丢失最近提交的事务
+    "busy_timeout": 5000,  # 遇到写锁时最多等待5秒,而不是立刻报"database is locked"
+    "cache_size": -65536,  # 每个连接的页缓存,负数的单位是KiB,即64MiB
+    "mmap_size": 256 * 1024 * 1024,  # 用内存映射读取数据库文件,减少read()系统调用和内存拷贝
+    "temp_store": "MEMORY",  # 排序、GROUP BY等用到的临时表放在内存中
+}
+
+# SQL查询统计: 不打开echo也能看到每个请求执行了多少条SQL、花了多长时间,用于发现N+1查询和慢查询
+SLOW_QUERY_SECONDS = float(os.environ.get("CHAPTER07_SLOW_QUERY_MS", "100")) / 1000  # 超过这个耗时的SQL记入慢查询日志
+MANY_QUERIES_PER_REQUEST = int(os.environ.get("CHAPTER07_MANY_QUERIES", "50"))  # 单个请求超过这么多条SQL时记录警告
+
+
+class database_py_QueryStats:
+    "一个请求内执行的SQL条数和累计耗时(秒)"
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# 当前请求的统计,由database_py_QueryStatsMiddleware设置;def路由在线程池中执行时starlette会复制context,共享同一个对象
+database_py_query_stats: ContextVar[Optional[database_py_QueryStats]] = ContextVar("query_stats", default=None)
+
+
+class database_py_QueryMetrics:
+    "进程内所有engine的SQL查询累计统计"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.slow_queries = 0
+        self.requests = 0
+        self.max_queries_per_request = 0
+
+    def record_query(self, seconds: float, slow: bool):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+            self.slow_queries += slow
+
+    def record_request(self, stats: database_py_QueryStats):
+        with self._lock:
+            self.requests += 1
+            self.max_queries_per_request = max(self.max_queries_per_request, stats.count)
+
+    def stats(self):
+        with self._lock:
+            return {"queries": self.queries, "query_seconds": self.query_seconds, "slow_queries": self.slow_queries,
+                    "requests": self.requests, "max_queries_per_request": self.max_queries_per_request}
+
+
+database_py_query_metrics = database_py_QueryMetrics()
+
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def database_py_normalize_sql(statement: str):
+    "把SQL中的字面量替换为?,IN列表合并为(?...),并压缩空白,同一种查询归一为同一条文本"
+    statement = SQL_LITERAL_RE.sub("?", statement)
+    statement = SQL_IN_LIST_RE.sub("(?...)", statement)
+    return " ".join(statement.split())
+
+
+def database_py_instrument(engine):
+    "在engine上注册SQL执行前后的事件,统计到当前请求和全局指标,并记录慢查询"
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        stats = database_py_query_stats.get()
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += seconds
+        slow = seconds >= SLOW_QUERY_SECONDS
+        database_py_query_metrics.record_query(seconds, slow)
+        if slow:
+            logger.warning("slow query %.1fms%s: %s", seconds * 1000, " (executemany)" if executemany else "",
+                           database_py_normalize_sql(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # 执行出错的语句不会触发after_cursor_execute,要在这里丢弃它的开始时间,否则会一直留在连接池的连接上
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    return engine
+
+
+class database_py_QueryStatsMiddleware:
+    """纯ASGI中间件: 为每个请求统计SQL,并添加X-DB-Queries(条数)和X-DB-Time(秒)响应头
+    用法: app.add_middleware(database_py_QueryStatsMiddleware)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = database_py_QueryStats()
+        token = database_py_query_stats.set(stats)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = message.setdefault("headers", [])
+                if not isinstance(headers, list):
+                    headers = message["headers"] = list(headers)
+                headers.append((b"x-db-queries", b"%d" % stats.count))
+                headers.append((b"x-db-time", b"%.6f" % stats.seconds))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            database_py_query_stats.reset(token)
+            database_py_query_metrics.record_request(stats)
+            if stats.count > MANY_QUERIES_PER_REQUEST:
+                logger.warning("%s %s executed %d queries (%.1fms), possible N+1",
+                               scope["method"], scope["path"], stats.count, stats.seconds * 1000)
+
+
+def database_py_create_engine(url: str = DATABASE_URL, profile: str = DATABASE_PROFILE):
+    "按配置创建engine,profile为dev或prod"
+    if profile == "dev":
+        return database_py_instrument(
+            create_engine(url, encoding='utf-8', echo=True, connect_args={'check_same_thread': False}))
+    if profile != "prod":
+        raise ValueError(f"unknown database profile: {profile!r}")
+    if not url.startswith("sqlite"):
+        return database_py_instrument(create_engine(url, encoding='utf-8', echo=False, pool_pre_ping=True))
+
+    # 连接池保持长连接: 每个连接的页缓存和mmap可以跨请求复用,也不用每次重新执行PRAGMA
+    engine = create_engine(url, encoding='utf-8', echo=False, poolclass=QueuePool, pool_size=8, max_overflow=8,
+                           connect_args={'check_same_thread': False, 'timeout': SQLITE_PRAGMAS["busy_timeout"] / 1000})
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return database_py_instrument(engine)
+
+
 # Connecting
-database_py_engine = create_engine(
-    # 数据库url格式:'数据库类型+数据库驱动名称://用户名:口令@机器地址:端口号/数据库名'
-    'sqlite:///./tutorial/chapter07.sqlite3',
-    encoding='utf-8', echo=True, connect_args={'check_same_thread': False}
-)
+database_py_engine = database_py_create_engine()
 
 # Declare a Mapping
 database_py_Base = declarative_base(bind=database_py_engine, name='Base')
@@ -43,6 +242,25 @@ database_py_Base = declarative_base(bind=database_py_engine, name='Base')
 database_py_session = sessionmaker(
     bind=database_py_engine, autoflush=False, autocommit=False, expire_on_commit=True)
 
+
+def database_py_create_all(engine):
+    """建表,并为已经存在的表补建模型中新增的索引
+    metadata.create_all只创建不存在的表,不会给旧版本建好的表加索引(如data表上的(province_id, date)唯一索引)。
+    """
+    database_py_Base.metadata.create_all(bind=engine)
+    inspector = sqlalchemy_inspect(engine)
+    for table in database_py_Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=engine)
+                logger.info("created missing index %s on %s", index.name, table.name)
+            except IntegrityError:
+                # 旧数据中有重复行时无法建唯一索引,需要先清理重复数据
+                logger.error("cannot create unique index %s: table %s has duplicate rows", index.name, table.name)
+
 """
 2. 建立ORM
 在项目结构总，下面代码可放在models.py中。
@@ -80,6 +298,11 @@ class models_py_Province(database_py_Base):
 
 class models_py_Data(database_py_Base):
     __tablename__ = "data"
+    __table_args__ = (
+        # 一个省份一天只有一条数据;按省份取时间线、增量同步和keyset分页都走这个复合索引
+        Index("ix_data_province_id_date", "province_id", "date", unique=True),
+        Index("ix_data_date", "date"),  # 按日期范围查询/聚合
+    )
     # Column的name参数是数据库表的字段名,它被省略则自动赋值为python变量名
     id = Column(Integer, primary_key=True, autoincrement=True)
     # ForeignKey里的字符串格式不是类名.属性名，而是表名.字段名
@@ -98,6 +321,28 @@ class models_py_Data(database_py_Base):
         return f"<确诊数:{self.confirm_num} 治愈数:{self.cure_num} 死亡数:{self.death_num}>"
 
 
+class models_py_ProvinceDailySummary(database_py_Base):
+    """每个省份每天的汇总数据(物化的统计结果),由同步任务和写接口在写data表时增量维护,
+    统计类的读接口直接读这张表,不需要每次在data表上重新计算窗口函数。
+    """
+    __tablename__ = "province_daily_summary"
+    __table_args__ = (
+        Index("ix_province_daily_summary_date", "date"),  # 全国按日合计时按日期范围扫描
+    )
+    province_id = Column(Integer, ForeignKey('province.id'), primary_key=True, comment="所属省/直辖市")
+    date = Column(Date, primary_key=True, comment="数据日期")
+    confirm_num = Column(BigInteger, nullable=False, comment="累计确诊数")
+    death_num = Column(BigInteger, nullable=False, comment="累计死亡数")
+    cure_num = Column(BigInteger, nullable=False, comment="累计治愈数")
+    confirm_delta = Column(BigInteger, nullable=False, comment="新增确诊数")
+    death_delta = Column(BigInteger, nullable=False, comment="新增死亡数")
+    confirm_avg = Column(Float, nullable=False, comment="新增确诊数的7日平均")
+    death_avg = Column(Float, nullable=False, comment="新增死亡数的7日平均")
+
+    def __repr__(self) -> str:
+        return f"<日期:{self.date} 新增确诊数:{self.confirm_delta} 7日平均:{self.confirm_avg}>"
+
+
 """
 3. 建立pandatic.BaseModel数据模型
 
@@ -131,6 +376,11 @@ class schemas_py_Create_Data(BaseModel):
     cure_num: int
 
 
+class schemas_py_Create_Data_Item(schemas_py_Create_Data):
+    "批量写入时的一条数据: 每条数据自带省份名,一个批次可以包含多个省份"
+    province_name: str
+
+
 class schemas_py_Read_Data(schemas_py_Create_Data):
     id: int
     province_id: int
@@ -141,6 +391,43 @@ class schemas_py_Read_Data(schemas_py_Create_Data):
         orm_mode = True
 
 
+class schemas_py_Page_Province(BaseModel):
+    "keyset分页的响应: next_cursor为None表示没有下一页"
+    items: List[schemas_py_Read_Province]
+    next_cursor: Optional[str]
+
+
+class schemas_py_Daily_Stats(BaseModel):
+    "按日聚合的统计: 累计数、日增量(和前一天的差值)以及日增量的N日滑动平均"
+    date: date_
+    confirm_num: int
+    death_num: int
+    confirm_delta: int
+    death_delta: int
+    confirm_avg: float
+    death_avg: float
+
+
+class schemas_py_Latest_Data(BaseModel):
+    "每个省份最新一天的数据"
+    province_name: str
+    date: date_
+    confirm_num: int
+    death_num: int
+    cure_num: int
+
+
+class schemas_py_SyncMode(str, Enum):
+    full = "full"  # 清空后全量重新写入
+    incremental = "incremental"  # 只写入新增和变化的数据
+
+
+class schemas_py_ExportFormat(str, Enum):
+    ndjson = "ndjson"  # 每行一个JSON对象
+    csv = "csv"  # 第一行是列名
+    arrow = "arrow"  # Apache Arrow IPC流格式(列式、带类型),需要安装pyarrow
+
+
 """
 4. orm数据库接口
 在项目结构中，可以写在crud.py
@@ -155,6 +442,8 @@ def crud_py_create_province(db: Session, province: schemas_py_Create_Province):
     # commit会默认调用flush，并提交当前事务,这标志事务执行完毕。
     db.commit()  # 提交缓存的事务
     db.refresh(province_model)  # 刷新数据表到对象关系模型的映射
+    cache_py_province_cache.invalidate(province_model.province_name)
+    cache_py_data_version.bump()
     return province_model  # 返回对象关系模型
 
 
@@ -168,32 +457,1216 @@ def crud_py_get_province_by_name(db: Session, province_name):
     return db.query(models_py_Province).filter(models_py_Province.province_name == province_name).first()
 
 
+def crud_py_get_province_ids_by_names(db: Session, province_names: Iterable[str]):
+    "批量取回 省份名 -> 主键ID,缓存未命中的省份用一条IN查询取回;不存在的省份不在结果中"
+    province_ids, missing = {}, []
+    for province_name in set(province_names):
+        province_id = cache_py_province_cache.get(province_name)
+        if province_id is None:
+            missing.append(province_name)
+        else:
+            province_ids[province_name] = province_id
+    if missing:
+        found = dict(db.query(models_py_Province.province_name, models_py_Province.id).filter(
+            models_py_Province.province_name.in_(missing)))
+        cache_py_province_cache.update(found)
+        province_ids.update(found)
+    return province_ids
+
+
+def crud_py_get_province_id_by_name(db: Session, province_name: str):
+    "取回province name对应的主键ID,优先从进程内缓存中取,不存在时返回None"
+    province_id = cache_py_province_cache.get(province_name)
+    if province_id is None:
+        province_id = db.query(models_py_Province.id).filter(
+            models_py_Province.province_name == province_name).scalar()
+        if province_id is not None:
+            cache_py_province_cache.set(province_name, province_id)
+    return province_id
+
+
+# 列表接口直接用Core查询取回元组,再按列名组装成dict,省掉ORM对象和Pydantic模型的构造
+PROVINCE_COLUMNS = list(models_py_Province.__table__.c)
+PROVINCE_KEYS = [column.name for column in PROVINCE_COLUMNS]
+DATA_COLUMNS = list(models_py_Data.__table__.c)
+DATA_KEYS = [column.name for column in DATA_COLUMNS]
+
+
+def crud_py_province_dicts(rows):
+    return [dict(zip(PROVINCE_KEYS, row)) for row in rows]
+
+
 def crud_py_get_provinces(db: Session, offset: int, limit: int):
-    "在province表中,取回一部分城市的数据项"
-    return db.query(models_py_Province).offset(offset).limit(limit).all()
+    "在province表中,取回一部分城市的数据项(dict)"
+    query = select(PROVINCE_COLUMNS).order_by(models_py_Province.id).offset(offset).limit(limit)
+    return crud_py_province_dicts(db.execute(query))
     # return db.query(models_py_Province).order_by(models_py_Province.country_code).offset(offset).limit(limit).all()
 
 
+def crud_py_encode_cursor(*values):
+    "把上一页最后一行的排序键编码成不透明的游标字符串"
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def crud_py_decode_cursor(cursor: str, *converters):
+    """解码游标并依次用converters转换每个排序键,空字符串表示第一页(返回None);游标不合法时抛出ValueError"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(converters):
+            raise ValueError
+        return tuple(converter(value) for converter, value in zip(converters, values))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor!r}") from e
+
+
+def crud_py_get_provinces_page(db: Session, cursor: str = None, limit: int = 10):
+    """keyset分页: 按主键id排序,用 id > 上一页最后的id 代替offset,翻到多深都只扫描limit行
+    返回(当前页数据, 下一页游标)
+    """
+    query = select(PROVINCE_COLUMNS).order_by(models_py_Province.id)
+    last = crud_py_decode_cursor(cursor, int)
+    if last is not None:
+        query = query.where(models_py_Province.id > last[0])
+    provinces = crud_py_province_dicts(db.execute(query.limit(limit + 1)))  # 多取一行,用来判断是否还有下一页
+    if len(provinces) <= limit:
+        return provinces, None
+    provinces = provinces[:limit]
+    return provinces, crud_py_encode_cursor(provinces[-1]["id"])
+
+
 def crud_py_create_province_data(db: Session, data: schemas_py_Create_Data, province_id: int):
     "创建疫情数据表"
     data_model = models_py_Data(**data.dict(), province_id=province_id)
-    db.add(data_model)
-    db.commit()
+    try:
+        db.add(data_model)
+        db.flush()  # 该省份这一天已有数据时违反(province_id, date)唯一索引,抛出IntegrityError
+        crud_py_refresh_summary(db, {province_id: data_model.date})  # 汇总表和data表在同一个事务中提交
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    cache_py_data_version.bump()
     db.refresh(data_model)
     return data_model
 
 
+# 同步数据时每批写入的行数: 一批对应一次executemany,批越大往返越少,但单次占用的内存越多
+SYNC_CHUNK_SIZE = 1000
+
+
+def crud_py_bulk_create_data(db: Session, rows: Iterable[dict], chunk_size: int = SYNC_CHUNK_SIZE):
+    """批量写入疫情数据表,返回写入的行数
+    每chunk_size行调用一次bulk_insert_mappings(底层是executemany),这里只flush不commit,由调用方决定何时提交事务。
+    """
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            db.bulk_insert_mappings(models_py_Data, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.bulk_insert_mappings(models_py_Data, chunk)
+        count += len(chunk)
+    return count
+
+
+def crud_py_create_data_batch(db: Session, items: List[Tuple[int, schemas_py_Create_Data_Item]],
+                              chunk_size: int = SYNC_CHUNK_SIZE):
+    """批量写入疫情数据,items是 (序号, 数据) 的列表。返回(写入的行数, 错误列表[{"index", "detail"}])
+    省份ID只解析一次;省份不存在、批次内重复、数据库中已存在的条目记为错误并跳过,其余条目在一个事务中写入,
+    并只刷新受影响省份从最早日期开始的汇总行。
+    """
+    errors = []
+    province_ids = crud_py_get_province_ids_by_names(db, (item.province_name for _, item in items))
+    accepted = {}  # (province_id, date) -> (序号, 数据)
+    for index, item in items:
+        province_id = province_ids.get(item.province_name)
+        if province_id is None:
+            errors.append({"index": index, "detail": f"province not found: {item.province_name}"})
+            continue
+        key = (province_id, item.date)
+        if key in accepted:
+            errors.append({"index": index, "detail": f"duplicate of item {accepted[key][0]}"})
+            continue
+        accepted[key] = (index, item)
+
+    # 一条查询取回这些省份在日期范围内已有的数据,在Python中求交集
+    existing = set()
+    if accepted:
+        dates = [date for _, date in accepted]
+        existing = set(db.query(models_py_Data.province_id, models_py_Data.date).filter(
+            models_py_Data.province_id.in_({province_id for province_id, _ in accepted}),
+            models_py_Data.date.between(min(dates), max(dates))))
+    rows, changed_since = [], {}
+    for (province_id, date), (index, item) in accepted.items():
+        if (province_id, date) in existing:
+            errors.append({"index": index, "detail": "data already exists"})
+            continue
+        rows.append(dict(item.dict(exclude={"province_name"}), province_id=province_id))
+        changed_since[province_id] = min(date, changed_since.get(province_id, date))
+
+    try:
+        crud_py_bulk_create_data(db, rows, chunk_size)
+        crud_py_refresh_summary(db, changed_since)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if rows:
+        cache_py_data_version.bump()
+    errors.sort(key=lambda error: error["index"])
+    return len(rows), errors
+
+
+def crud_py_iter_timeline_rows(location: dict, province_id: int):
+    "把上游一个location的timelines逐条转换成data表的一行(字典形式)"
+    deaths = location["timelines"]["deaths"]["timeline"]
+    for date, confirmed in location["timelines"]["confirmed"]["timeline"].items():
+        yield {
+            "province_id": province_id,  # 这个province_id是province表中的主键ID，不是上游数据里的ID
+            # 把'2020-12-31T00:00:00Z' 变成 date(2020, 12, 31)
+            "date": date_.fromisoformat(date.split("T")[0]),
+            "confirm_num": confirmed,
+            "death_num": deaths[date],
+            "cure_num": 0,  # 每个城市每天有多少人痊愈，这种数据没有
+        }
+
+
+def crud_py_reload_coronavirus_data(db: Session, provinces: List[dict], locations: Iterable[dict],
+                                    chunk_size: int = SYNC_CHUNK_SIZE):
+    """在同一个事务中清空并重新写入province表和data表,返回写入data表的行数
+    整个"先删后写"只在最后commit一次,读者要么看到旧数据,要么看到新数据,不会看到写了一半的表;中途出错则整体回滚。
+    """
+    try:
+        db.query(models_py_ProvinceDailySummary).delete(synchronize_session=False)
+        db.query(models_py_Data).delete(synchronize_session=False)
+        db.query(models_py_Province).delete(synchronize_session=False)
+        db.bulk_insert_mappings(models_py_Province, provinces)
+        # 一次查询拿到全部 省份名->主键ID 的映射,避免每个省份单独查询
+        province_ids = dict(db.query(models_py_Province.province_name, models_py_Province.id))
+        rows = (row for location in locations
+                for row in crud_py_iter_timeline_rows(location, province_ids[location["province"]]))
+        count = crud_py_bulk_create_data(db, rows, chunk_size)
+        crud_py_refresh_summary(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    # 提交之后旧的省份ID全部失效,用刚查到的映射重新填充缓存
+    cache_py_province_cache.invalidate()
+    cache_py_province_cache.update(province_ids)
+    cache_py_data_version.bump()
+    return count
+
+
+# 增量同步时回看的天数: 上游会修正最近几天的数据,所以只比较"最后同步日期-回看天数"之后的行,更早的行视为未变化
+SYNC_LOOKBACK_DAYS = 7
+
+
+def crud_py_sync_coronavirus_data(db: Session, provinces: List[dict], locations: Iterable[dict],
+                                  chunk_size: int = SYNC_CHUNK_SIZE, lookback_days: int = SYNC_LOOKBACK_DAYS):
+    """增量同步province表和data表,返回 {"inserted": 新增行数, "updated": 更新行数, "unchanged": 未变化行数}
+    按省份记录data表中最后同步的日期,只对最近lookback_days天内的(province_id, date)做比较,
+    新日期的行批量插入,数值有变化的行批量更新,写入量只和变化量有关,和历史数据总量无关。
+    """
+    try:
+        # 1. province表: 新省份插入,人口有变化的省份更新
+        existing = {province.province_name: province for province in db.query(models_py_Province)}
+        for province in provinces:
+            province_model = existing.get(province["province_name"])
+            if province_model is not None and province_model.country_population != province["country_population"]:
+                province_model.country_population = province["country_population"]
+                province_model.update_at = datetime.now()
+        new_provinces = [province for province in provinces if province["province_name"] not in existing]
+        province_ids = {name: province_model.id for name, province_model in existing.items()}
+        if new_provinces:
+            # 只有出现新省份时才需要再查一次它们的主键ID
+            db.bulk_insert_mappings(models_py_Province, new_provinces)
+            db.flush()
+            province_ids.update(db.query(models_py_Province.province_name, models_py_Province.id).filter(
+                models_py_Province.province_name.in_([province["province_name"] for province in new_provinces])))
+
+        # 2. data表: 每个省份最后同步的日期
+        last_dates = dict(db.query(models_py_Data.province_id, func.max(models_py_Data.date))
+                          .group_by(models_py_Data.province_id))
+        stats = {"inserted": 0, "updated": 0, "unchanged": 0}
+        changed = []
+        changed_since = {}  # province_id -> 该省份有新增或变化的最早日期,用来增量刷新汇总表
+
+        def mark_changed(row):
+            since = changed_since.get(row["province_id"])
+            if since is None or row["date"] < since:
+                changed_since[row["province_id"]] = row["date"]
+
+        def rows_to_insert():
+            for location in locations:
+                province_id = province_ids[location["province"]]
+                last_date = last_dates.get(province_id)
+                window = {}
+                if last_date is not None:
+                    window_start = last_date - timedelta(days=lookback_days)
+                    window = {date: (id_, confirm_num, death_num) for id_, date, confirm_num, death_num in db.query(
+                        models_py_Data.id, models_py_Data.date, models_py_Data.confirm_num, models_py_Data.death_num,
+                    ).filter(models_py_Data.province_id == province_id, models_py_Data.date >= window_start)}
+                for row in crud_py_iter_timeline_rows(location, province_id):
+                    if last_date is None or row["date"] > last_date:
+                        mark_changed(row)
+                        yield row
+                    elif row["date"] < window_start:
+                        stats["unchanged"] += 1
+                    elif row["date"] not in window:
+                        # 回看窗口内库中缺少的日期(上次同步时上游缺失,或create_data写入了更晚的日期)同样要插入
+                        mark_changed(row)
+                        yield row
+                    elif window[row["date"]][1:] == (row["confirm_num"], row["death_num"]):
+                        stats["unchanged"] += 1
+                    else:
+                        mark_changed(row)
+                        changed.append({"id": window[row["date"]][0],
+                                        "confirm_num": row["confirm_num"],
+                                        "death_num": row["death_num"],
+                                        "update_at": datetime.now()})
+
+        stats["inserted"] = crud_py_bulk_create_data(db, rows_to_insert(), chunk_size)
+        for i in range(0, len(changed), chunk_size):
+            db.bulk_update_mappings(models_py_Data, changed[i:i + chunk_size])
+        stats["updated"] = len(changed)
+        crud_py_refresh_summary(db, changed_since)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    cache_py_province_cache.update(province_ids)
+    if stats["inserted"] or stats["updated"] or new_provinces:
+        cache_py_data_version.bump()
+    return stats
+
+
+# 汇总表中滑动平均的天数
+SUMMARY_WINDOW = 7
+
+
+def crud_py_select_summary(province_id: int = None, since: date_ = None):
+    """从data表计算汇总数据的SELECT语句(窗口函数按省份分区),可以限定省份和起始日期。
+    指定since时(需要同时指定province_id)多读该省份since之前的SUMMARY_WINDOW行data,保证since当天的增量和滑动平均是完整的。
+    """
+    data = models_py_Data.__table__
+    deltas = select([
+        data.c.province_id, data.c.date, data.c.confirm_num, data.c.death_num, data.c.cure_num,
+        (data.c.confirm_num - func.lag(data.c.confirm_num, 1, 0).over(
+            partition_by=data.c.province_id, order_by=data.c.date)).label("confirm_delta"),
+        (data.c.death_num - func.lag(data.c.death_num, 1, 0).over(
+            partition_by=data.c.province_id, order_by=data.c.date)).label("death_delta"),
+    ])
+    if province_id is not None:
+        deltas = deltas.where(data.c.province_id == province_id)
+    if since is not None:
+        assert province_id is not None, "since只能和province_id一起使用: 各省份回看的起点不同"
+        deltas = deltas.where(data.c.date >= crud_py_lookback_date(
+            data, since, SUMMARY_WINDOW, data.c.province_id == province_id))
+    deltas = deltas.alias("deltas")
+
+    rolling = (-(SUMMARY_WINDOW - 1), 0)  # ROWS BETWEEN 6 PRECEDING AND CURRENT ROW
+    summary = select([
+        deltas.c.province_id, deltas.c.date, deltas.c.confirm_num, deltas.c.death_num, deltas.c.cure_num,
+        deltas.c.confirm_delta, deltas.c.death_delta,
+        func.avg(deltas.c.confirm_delta).over(
+            partition_by=deltas.c.province_id, order_by=deltas.c.date, rows=rolling).label("confirm_avg"),
+        func.avg(deltas.c.death_delta).over(
+            partition_by=deltas.c.province_id, order_by=deltas.c.date, rows=rolling).label("death_avg"),
+    ]).alias("summary")
+    query = select([summary])
+    if since is not None:
+        query = query.where(summary.c.date >= since)
+    return query
+
+
+def crud_py_refresh_summary(db: Session, changed_since: dict = None):
+    """刷新汇总表,不提交事务。
+    changed_since为 {province_id: 最早变化的日期} 时只重算这些省份从该日期开始的汇总行,工作量只和变化量有关;
+    为None时清空后全量重算。整个计算通过INSERT ... SELECT在数据库中完成。
+    """
+    summary = models_py_ProvinceDailySummary.__table__
+    columns = [column.name for column in summary.columns]
+    if changed_since is None:
+        db.execute(summary.delete())
+        db.execute(summary.insert().from_select(columns, crud_py_select_summary()))
+        return
+    for province_id, since in changed_since.items():
+        db.execute(summary.delete().where(and_(summary.c.province_id == province_id, summary.c.date >= since)))
+        db.execute(summary.insert().from_select(columns, crud_py_select_summary(province_id, since)))
+
+
+def crud_py_backfill_summary(db: Session):
+    """汇总表为空而data表有数据时(如在汇总表出现之前建好的数据库)全量计算一次汇总表并提交,返回是否执行了计算
+    增量同步只刷新变化日期之后的汇总行,不会补齐更早的历史。
+    """
+    summary = models_py_ProvinceDailySummary
+    if db.query(summary.province_id).first() is not None or db.query(models_py_Data.id).first() is None:
+        return False
+    try:
+        crud_py_refresh_summary(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    cache_py_data_version.bump()
+    logger.info("backfilled province_daily_summary from the data table")
+    return True
+
+
+def crud_py_check_summary(db: Session):
+    """一致性检查: 把汇总表和全量重算的结果逐行比较,返回不一致的行
+    每一项为 {"province_id", "date", "expected", "actual"},缺行或多行时对应的一边为None。
+    """
+    actual = {(row.province_id, row.date): dict(row) for row in db.execute(
+        select([models_py_ProvinceDailySummary.__table__]))}
+    expected = {(row.province_id, row.date): dict(row) for row in db.execute(crud_py_select_summary())}
+    mismatches = []
+    for key in sorted(actual.keys() | expected.keys()):
+        want, got = expected.get(key), actual.get(key)
+        if want is not None and got is not None and all(
+                abs(want[name] - got[name]) < 1e-6 for name in want if name not in ("province_id", "date")):
+            continue
+        mismatches.append({"province_id": key[0], "date": key[1], "expected": want, "actual": got})
+    return mismatches
+
+
 def crud_py_get_data(db: Session, province_name: str = None, offset: int = 0, limit: int = 10):
     "在疫情数据表中,取回province name对应的所有数据项 或 最新的一堆数据项 "
-    data = db.query(models_py_Data)
+    # 按(province_id, date)排序,结果顺序确定,并且可以直接走ix_data_province_id_date索引
+    data = db.query(models_py_Data).order_by(models_py_Data.province_id, models_py_Data.date)
     if province_name is not None:
-        data = data.filter(models_py_Data.province.has(
-            province_name=province_name)).all()
+        # 显式join代替province.has()生成的EXISTS子查询,contains_eager把join到的province直接填充到关系属性上
+        data = data.join(models_py_Data.province).options(contains_eager(models_py_Data.province)).filter(
+            models_py_Province.province_name == province_name).all()
     else:
-        data = data.offset(offset).limit(limit).all()
+        # joinedload在同一条SQL中取回province,否则模板中每访问一次d.province都会多一次SELECT(N+1问题)
+        data = data.options(joinedload(models_py_Data.province)).offset(offset).limit(limit).all()
     return data
 
 
+def crud_py_select_data(province_name: str = None):
+    "data join province的Core查询,按(province_id, date)排序;每行依次是data表和province表的全部列"
+    query = select(DATA_COLUMNS + PROVINCE_COLUMNS).select_from(
+        models_py_Data.__table__.join(models_py_Province.__table__)).order_by(
+        models_py_Data.province_id, models_py_Data.date).apply_labels()
+    if province_name is not None:
+        query = query.where(models_py_Province.province_name == province_name)
+    return query
+
+
+def crud_py_data_dicts(rows):
+    "把crud_py_select_data的结果组装成和ORM对象序列化结果相同结构的dict: data的列 + province(嵌套dict)"
+    n = len(DATA_KEYS)
+    return [dict(zip(DATA_KEYS, row[:n]), province=dict(zip(PROVINCE_KEYS, row[n:]))) for row in rows]
+
+
+def crud_py_get_data_rows(db: Session, province_name: str = None, offset: int = 0, limit: int = 10):
+    "同crud_py_get_data,但直接返回dict,供列表接口序列化"
+    query = crud_py_select_data(province_name)
+    if province_name is None:
+        query = query.offset(offset).limit(limit)
+    return crud_py_data_dicts(db.execute(query))
+
+
+def crud_py_get_data_page(db: Session, province_name: str = None, cursor: str = None, limit: int = 10):
+    """keyset分页: 按(province_id, date)排序,用 (province_id, date) > 上一页最后一行 代替offset,
+    走ix_data_province_id_date索引,翻到多深都和第一页一样快。返回(当前页数据(dict), 下一页游标)
+    """
+    query = crud_py_select_data(province_name)
+    last = crud_py_decode_cursor(cursor, int, date_.fromisoformat)
+    if last is not None:
+        query = query.where(tuple_(models_py_Data.province_id, models_py_Data.date) > tuple_(*last))
+    data = crud_py_data_dicts(db.execute(query.limit(limit + 1)))  # 多取一行,用来判断是否还有下一页
+    if len(data) <= limit:
+        return data, None
+    data = data[:limit]
+    return data, crud_py_encode_cursor(data[-1]["province_id"], data[-1]["date"])
+
+
+# 导出时每批从游标取回的行数,也是响应流中每个数据块包含的行数
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = [models_py_Data.province_id, models_py_Province.province_name, models_py_Province.country_code,
+                  models_py_Data.date, models_py_Data.confirm_num, models_py_Data.death_num, models_py_Data.cure_num]
+EXPORT_KEYS = [column.key for column in EXPORT_COLUMNS]
+
+
+def crud_py_iter_export(db: Session, province_id: int = None, start_date: date_ = None, end_date: date_ = None,
+                        batch_size: int = EXPORT_BATCH_SIZE):
+    """按(province_id, date)顺序逐批取回要导出的数据,每批是元组的列表。
+    yield_per让结果通过游标分批取回(支持时使用服务端游标),而不是.all()一次性全部读进内存,占用的内存和总行数无关。
+    """
+    query = db.query(*EXPORT_COLUMNS).select_from(models_py_Data).join(models_py_Data.province).order_by(
+        models_py_Data.province_id, models_py_Data.date)
+    if province_id is not None:
+        query = query.filter(models_py_Data.province_id == province_id)
+    if start_date is not None:
+        query = query.filter(models_py_Data.date >= start_date)
+    if end_date is not None:
+        query = query.filter(models_py_Data.date <= end_date)
+    batch = []
+    for row in query.yield_per(batch_size):
+        batch.append(tuple(row))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def crud_py_get_daily_stats(db: Session, province_name: str = None, start_date: date_ = None,
+                            end_date: date_ = None, window: int = SUMMARY_WINDOW):
+    """按日聚合的统计: 累计数、日增量和日增量的window日滑动平均(不传province_name时是全国合计)。
+    window等于SUMMARY_WINDOW时直接读汇总表,代价只和结果行数有关;否则回退到在data表上计算。两种方式的结果相同。
+    """
+    if window != SUMMARY_WINDOW:
+        return crud_py_compute_daily_stats(db, province_name, start_date, end_date, window)
+    summary = models_py_ProvinceDailySummary
+    if province_name is not None:
+        query = db.query(summary.date, summary.confirm_num, summary.death_num, summary.confirm_delta,
+                         summary.death_delta, summary.confirm_avg, summary.death_avg).join(
+            models_py_Province, models_py_Province.id == summary.province_id).filter(
+            models_py_Province.province_name == province_name)
+        if start_date is not None:
+            query = query.filter(summary.date >= start_date)
+        if end_date is not None:
+            query = query.filter(summary.date <= end_date)
+        return [row._asdict() for row in query.order_by(summary.date)]
+
+    # 全国: 汇总表中存的是各省份的日增量,按日期求和之后再在全国的序列上计算滑动平均
+    # (只有所有省份的日期都相同时,各省份滑动平均之和才等于全国的滑动平均)
+    table = summary.__table__
+    series = select([
+        table.c.date,
+        func.sum(table.c.confirm_num).label("confirm_num"),
+        func.sum(table.c.death_num).label("death_num"),
+        func.sum(table.c.confirm_delta).label("confirm_delta"),
+        func.sum(table.c.death_delta).label("death_delta"),
+    ]).group_by(table.c.date)
+    if start_date is not None:
+        series = series.where(table.c.date >= crud_py_lookback_date(table, start_date, window - 1))
+    if end_date is not None:
+        series = series.where(table.c.date <= end_date)
+    return [dict(row) for row in db.execute(crud_py_rolling_stats(series.alias("series"), start_date, window))]
+
+
+def crud_py_lookback_date(table, start: date_, rows: int, *criteria):
+    """start之前第rows个不同日期的标量子查询(criteria可以限定省份),不足rows个时取最早的日期,一个都没有时就是start。
+    增量和滑动平均的窗口按行数(ROWS)计算,数据不是每天都有时,回看的起点不能用start减去若干天。
+    """
+    recent = select([table.c.date]).where(and_(table.c.date < start, *criteria)).distinct().order_by(
+        table.c.date.desc()).limit(rows).alias("recent")
+    return select([func.coalesce(func.min(recent.c.date), start)]).as_scalar()
+
+
+def crud_py_rolling_stats(series, start_date: date_ = None, window: int = SUMMARY_WINDOW):
+    """在按日期的序列(date, confirm_num, death_num, confirm_delta, death_delta)上计算日增量的window行滑动平均,
+    返回从start_date开始的行。series需要包含start_date之前的window-1个日期,第一天的滑动平均才是完整的。
+    """
+    rolling = (-(window - 1), 0)  # ROWS BETWEEN window-1 PRECEDING AND CURRENT ROW
+    stats = select([
+        series.c.date, series.c.confirm_num, series.c.death_num, series.c.confirm_delta, series.c.death_delta,
+        func.avg(series.c.confirm_delta).over(order_by=series.c.date, rows=rolling).label("confirm_avg"),
+        func.avg(series.c.death_delta).over(order_by=series.c.date, rows=rolling).label("death_avg"),
+    ]).alias("stats")
+    query = select([stats]).order_by(stats.c.date)
+    if start_date is not None:
+        query = query.where(stats.c.date >= start_date)
+    return query
+
+
+def crud_py_compute_daily_stats(db: Session, province_name: str = None, start_date: date_ = None,
+                                end_date: date_ = None, window: int = SUMMARY_WINDOW):
+    """按日聚合的统计,全部在SQL中完成: LAG窗口函数(按省份分区)得到每个省份的日增量,GROUP BY日期求和得到
+    每天的累计数和日增量(不传province_name时是全国合计),再在这个序列上用ROWS窗口上的AVG得到日增量的window日滑动平均。
+    全国的日增量是各省份日增量之和: 某个省份的数据提前结束时,不会被当成累计数的减少。
+    """
+    data = models_py_Data.__table__
+    criteria = []
+    if province_name is not None:
+        criteria.append(data.c.province_id == select([models_py_Province.id]).where(
+            models_py_Province.province_name == province_name).as_scalar())
+    deltas = select([
+        data.c.date, data.c.confirm_num, data.c.death_num,
+        (data.c.confirm_num - func.lag(data.c.confirm_num, 1, 0).over(
+            partition_by=data.c.province_id, order_by=data.c.date)).label("confirm_delta"),
+        (data.c.death_num - func.lag(data.c.death_num, 1, 0).over(
+            partition_by=data.c.province_id, order_by=data.c.date)).label("death_delta"),
+    ]).where(and_(*criteria))
+    if start_date is not None:
+        # 滑动平均要用到start_date之前的window-1个日期;这些日期上每个省份的增量又要用到该省份在它们之前的最后一行
+        first = crud_py_lookback_date(data, start_date, window - 1, *criteria)
+        previous = select([func.max(data.c.date).label("date")]).where(and_(data.c.date < first, *criteria)).group_by(
+            data.c.province_id).alias("previous")
+        deltas = deltas.where(data.c.date >= select([func.coalesce(func.min(previous.c.date), first)]).as_scalar())
+    if end_date is not None:
+        deltas = deltas.where(data.c.date <= end_date)
+    deltas = deltas.alias("deltas")
+
+    series = select([
+        deltas.c.date,
+        func.sum(deltas.c.confirm_num).label("confirm_num"),
+        func.sum(deltas.c.death_num).label("death_num"),
+        func.sum(deltas.c.confirm_delta).label("confirm_delta"),
+        func.sum(deltas.c.death_delta).label("death_delta"),
+    ]).group_by(deltas.c.date).alias("series")
+    return [dict(row) for row in db.execute(crud_py_rolling_stats(series, start_date, window))]
+
+
+def crud_py_get_latest_data(db: Session):
+    "每个省份最新一天的数据: 在汇总表上先GROUP BY取每个省份的最大日期(走主键索引),再取回对应的行"
+    summary = models_py_ProvinceDailySummary
+    latest = db.query(summary.province_id, func.max(summary.date).label("date")).group_by(
+        summary.province_id).subquery()
+    query = db.query(
+        models_py_Province.province_name, summary.date, summary.confirm_num, summary.death_num, summary.cure_num,
+    ).join(models_py_Province, models_py_Province.id == summary.province_id).join(
+        latest, and_(summary.province_id == latest.c.province_id, summary.date == latest.c.date),
+    ).order_by(models_py_Province.province_name)
+    return [row._asdict() for row in query]
+
+
+"""
+4.1 上游数据源(JHU)客户端
+在项目结构中，下面代码可放在upstream.py
+"""
+
+UPSTREAM_URL = "https://coronavirus-tracker-api.herokuapp.com/v2/locations"
+UPSTREAM_TIMEOUT = (3.05, 30)  # (连接超时, 读取超时),单位秒
+UPSTREAM_RETRIES = 3  # 连接失败、5xx和429时最多重试的次数
+UPSTREAM_BACKOFF = 0.5  # 指数退避因子: 第n次重试前等待 backoff * 2^(n-1) 秒
+UPSTREAM_CHUNK_SIZE = 64 * 1024  # 流式读取响应体时每次读取的字节数
+
+
+class upstream_py_Client:
+    """JHU上游数据源客户端
+        - 同一个requests.Session复用连接池(keep-alive),两份数据并发请求;
+        - 每个请求都带超时,失败时有限次数地指数退避重试;
+        - 缓存ETag/Last-Modified,下次以条件GET请求,上游未变化时服务器返回304,调用方据此跳过写库。
+    """
+
+    def __init__(self, url: str = UPSTREAM_URL, timeout=UPSTREAM_TIMEOUT, retries: int = UPSTREAM_RETRIES,
+                 backoff_factor: float = UPSTREAM_BACKOFF, pool_size: int = 4):
+        self.url = url
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="upstream")
+        self._validators = {}  # 请求url -> 条件请求头(If-None-Match/If-Modified-Since)
+        self._lock = threading.Lock()
+
+    def get(self, timelines: bool, conditional: bool = True, stream: bool = False):
+        "条件GET请求一份数据,上游未变化(304)时返回None;stream=True时响应体留给调用方流式读取"
+        params = {"source": "jhu", "country_code": "CN", "timelines": "true" if timelines else "false"}
+        url = requests.Request("GET", self.url, params=params).prepare().url
+        with self._lock:
+            headers = dict(self._validators.get(url, {})) if conditional else {}
+        response = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+        if response.status_code == 304 or response.status_code >= 400:
+            response.close()  # stream=True时响应不会自动关闭,要把连接还给连接池
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+        return response
+
+    def fetch_locations(self, conditional: bool = True):
+        """并发请求timelines=false和timelines=true两份数据,返回(province_response, timelines_response)
+        两份都未变化时返回None;只有一份变化时,另一份不带条件头重新请求,保证调用方总是拿到完整的两份数据。
+        timelines=true的数据量很大,以stream方式返回,由调用方用upstream_py_iter_locations边读边解析。
+        """
+        futures = [self._executor.submit(self.get, timelines, conditional, timelines) for timelines in (False, True)]
+        responses = []
+        try:
+            responses = [future.result() for future in futures]
+            if all(response is None for response in responses):
+                return None
+            for i, timelines in enumerate((False, True)):
+                if responses[i] is None:
+                    responses[i] = self.get(timelines, False, timelines)
+            return tuple(responses)
+        except Exception:
+            # 一份请求失败时关闭另一份已经拿到的(流式)响应,否则它会一直占用连接池中的连接
+            for future in futures:
+                if future.exception() is None and future.result() is not None:
+                    future.result().close()
+            for response in responses:
+                if response is not None:
+                    response.close()
+            raise
+
+    def remember(self, *responses):
+        "写库成功之后再记住这些响应的ETag/Last-Modified,写库失败时下次仍会完整请求"
+        with self._lock:
+            for response in responses:
+                validators = {}
+                if "ETag" in response.headers:
+                    validators["If-None-Match"] = response.headers["ETag"]
+                if "Last-Modified" in response.headers:
+                    validators["If-Modified-Since"] = response.headers["Last-Modified"]
+                self._validators[response.request.url] = validators
+
+    def forget(self):
+        "清空缓存的ETag/Last-Modified,下次请求必定拿到完整数据"
+        with self._lock:
+            self._validators.clear()
+
+
+def upstream_py_iter_json_array(chunks: Iterable[bytes], key: str):
+    """从字节流中逐个解析出顶层对象里key对应的数组元素(生成器)
+    内存中只保留当前元素的文本和解析结果,不会一次性把整份文档解析成Python对象。
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    chunks = iter(chunks)
+    buffer, pos, in_array = "", 0, False
+    while True:
+        if not in_array:
+            match = array_start.search(buffer)
+            if match is not None:
+                buffer, pos, in_array = buffer[match.end():], 0, True
+                continue
+            buffer = buffer[-(len(key) + 64):]  # key可能被截断在两个chunk之间,保留末尾一小段
+        else:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                if buffer[pos] == "]":
+                    return
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    pass  # 当前元素还没有接收完整,继续读下一个chunk
+                else:
+                    yield item
+                    continue
+            buffer, pos = buffer[pos:], 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError(f"unexpected end of JSON stream while reading {key!r}")
+        buffer += text_decoder.decode(chunk)
+
+
+def upstream_py_iter_locations(response: requests.Response):
+    "边下载边解析timelines=true响应中的locations,每次只产出一个location"
+    return upstream_py_iter_json_array(response.iter_content(chunk_size=UPSTREAM_CHUNK_SIZE), "locations")
+
+
+upstream_py_client = upstream_py_Client()
+
+
+"""
+4.2 进程内缓存
+在项目结构中，下面代码可放在cache.py
+"""
+
+PROVINCE_CACHE_SIZE = 1024  # 最多缓存的省份个数
+PROVINCE_CACHE_TTL = 300  # 缓存项的有效期,单位秒;多进程部署时用来限制其他进程写库后本进程缓存过期的时间
+
+
+class cache_py_LRUCache:
+    """进程内的LRU + TTL缓存,缓存项可以记录生成它时的数据版本号(cache_py_data_version)
+    get时传入当前版本号,版本号不同或已过期的缓存项视为未命中并被删除;不需要按版本失效的缓存(如省份ID)不传版本号。
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (值, 过期时间, 版本号)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version: int = None):
+        "命中时返回缓存的值,未命中、已过期或版本号不同时返回None"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= self._clock() or entry[2] != version:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, version: int = None):
+        with self._lock:
+            self._entries[key] = (value, self._clock() + self.ttl, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def update(self, values: dict):
+        "批量填充缓存"
+        for key, value in values.items():
+            self.set(key, value)
+
+    def invalidate(self, key=None):
+        "失效一个缓存项;不传key时清空整个缓存"
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+# 省份名 -> 主键ID: province表很小且很少变化,缓存之后create_data和同步任务解析省份ID不需要额外的SELECT;
+# crud_py_create_province和同步任务写province表之后会显式失效/重新填充
+cache_py_province_cache = cache_py_LRUCache(PROVINCE_CACHE_SIZE, PROVINCE_CACHE_TTL)
+
+
+class cache_py_DataVersion:
+    """数据版本号: 每次写库(写接口、同步任务)提交之后加一,响应缓存中版本号不同的缓存项即失效"""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+cache_py_data_version = cache_py_DataVersion()
+
+RESPONSE_CACHE_SIZE = 256  # 最多缓存的响应个数
+RESPONSE_CACHE_TTL = 60  # 缓存项的有效期,单位秒;多进程部署时其他进程写库不会让本进程的版本号变化,用它限制旧数据的时间
+RESPONSE_CACHE_MAX_BODY = 1024 * 1024  # 超过这个大小的响应体不缓存
+
+
+# (Host, 路径, 查询串) -> (ETag, 状态码, 响应头, 响应体),缓存项按数据版本号失效,见cache_py_CachedRoute
+cache_py_response_cache = cache_py_LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+FRAGMENT_CACHE_SIZE = 256  # 最多缓存的页面片段个数
+FRAGMENT_CACHE_TTL = 60  # 缓存项的有效期,单位秒,和响应缓存一样用来限制多进程部署时旧数据的时间
+
+
+# 渲染好的页面片段: (模版名, 查询参数) -> Markup,缓存项按数据版本号失效,见templates_py_Templates.render_fragment。
+# 响应缓存以整个URL为键,Host不同、TTL过期或被淘汰时都要重新渲染整页;片段缓存让这些情况下只需要渲染页面的外壳
+cache_py_fragment_cache = cache_py_LRUCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+
+
+class cache_py_CachedRoute(APIRoute):
+    """只读接口的路由类: 响应按(Host, 路径+查询串)缓存,数据版本号变化后失效。
+    响应带强ETag,请求头If-None-Match命中时直接返回304;缓存命中时不会执行依赖项(get_db)和接口函数,也就不会访问数据库。
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def cached_route_handler(request: Request):
+            if request.method != "GET":
+                return await handler(request)
+            key = (request.headers.get("host"), request.url.path, request.url.query)
+            version = cache_py_data_version.value  # 先取版本号: 执行期间有写入时,缓存项会在下次请求时失效
+            entry = cache_py_response_cache.get(key, version)
+            if entry is None:
+                response = await handler(request)
+                body = getattr(response, "body", None)  # StreamingResponse等没有body的响应不缓存
+                if response.status_code != 200 or body is None or len(body) > RESPONSE_CACHE_MAX_BODY:
+                    return response
+                headers = {k: v for k, v in response.headers.items() if k != "content-length"}
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                entry = cache_py_response_cache.set(key, (etag, response.status_code, headers, body), version)
+            etag, status_code, headers, body = entry
+            # 浏览器/客户端每次都要带上If-None-Match重新验证
+            cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if_none_match = request.headers.get("if-none-match")
+            if if_none_match is not None and (if_none_match.strip() == "*" or etag in (
+                    tag.strip().lstrip("W/") for tag in if_none_match.split(","))):
+                return Response(status_code=304, headers=cache_headers)
+            return Response(content=body, status_code=status_code, headers={**headers, **cache_headers})
+
+        return cached_route_handler
+
+
+"""
+4.3 同步任务的执行器
+在项目结构中，下面代码可放在jobs.py
+"""
+
+SYNC_JOB_HISTORY = 100  # 最多保留的已结束任务个数,供状态接口查询
+
+
+class job_py_JobCancelled(Exception):
+    "同步任务被取消,由任务自己在检查点抛出,写库的事务随之回滚"
+
+
+class job_py_SyncJob:
+    "一次同步任务: 记录状态、进度,并提供取消标志"
+
+    def __init__(self, source: str, mode: schemas_py_SyncMode):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.mode = mode
+        self.status = "pending"  # pending -> running -> succeeded/failed/cancelled
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.rows_processed = 0
+        self.locations_processed = 0
+        self.locations_total = None
+        self.result = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._started = None  # time.monotonic(),用于计算吞吐量
+
+    @property
+    def finished(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def wait(self, timeout: float = None):
+        "等待任务结束,结束时返回True"
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        "请求取消,任务会在下一个检查点(处理下一个location之前)停下"
+        self._cancel.set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise job_py_JobCancelled(self.id)
+
+    def track(self, locations: Iterable[dict], locations_total: int):
+        "包装location流水线: 统计处理的行数,并在每个location之前检查是否被取消"
+        self.locations_total = locations_total
+        for location in locations:
+            self.check_cancelled()
+            yield location
+            self.locations_processed += 1
+            self.rows_processed += len(location["timelines"]["confirmed"]["timeline"])
+
+    def to_dict(self):
+        elapsed = time.monotonic() - self._started if self._started is not None else 0
+        throughput = self.rows_processed / elapsed if elapsed > 0 else None
+        eta = None
+        if not self.finished and throughput and self.locations_total and self.locations_processed:
+            # 按已处理location的平均行数估算总行数
+            rows_total = self.rows_processed / self.locations_processed * self.locations_total
+            eta = max(rows_total - self.rows_processed, 0) / throughput
+        return {
+            "job_id": self.id, "source": self.source, "mode": self.mode.value, "status": self.status,
+            "created_at": self.created_at, "started_at": self.started_at, "finished_at": self.finished_at,
+            "rows_processed": self.rows_processed, "locations_processed": self.locations_processed,
+            "locations_total": self.locations_total, "rows_per_second": throughput, "eta_seconds": eta,
+            "result": self.result, "error": self.error,
+        }
+
+
+class job_py_SyncJobRunner:
+    """同步任务的执行器
+        - 每个数据源同时只运行一个任务(single flight),重复的同步请求合并到正在运行的任务上;
+        - 任务在独立的线程中运行,使用自己创建和关闭的Session,不依赖请求作用域的get_db;
+        - 通过任务ID查询进度或取消任务。
+    """
+
+    def __init__(self, session_factory=database_py_session, client: upstream_py_Client = upstream_py_client,
+                 history: int = SYNC_JOB_HISTORY):
+        self.session_factory = session_factory
+        self.client = client
+        self.history = history
+        self._jobs = OrderedDict()  # job_id -> job
+        self._running = {}  # source -> 正在运行的job
+        self._lock = threading.Lock()
+
+    def submit(self, source: str = "jhu", mode: schemas_py_SyncMode = schemas_py_SyncMode.incremental):
+        "提交同步任务,返回(job, 是否新建);该数据源已有任务在运行时直接返回那个任务"
+        with self._lock:
+            job = self._running.get(source)
+            if job is not None:
+                return job, False
+            job = job_py_SyncJob(source, mode)
+            self._running[source] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs.values()))
+                if not oldest.finished:
+                    break
+                self._jobs.popitem(last=False)
+        threading.Thread(target=self._run, args=(job,), name=f"sync-{source}", daemon=True).start()
+        return job, True
+
+    def _run(self, job: job_py_SyncJob):
+        db = self.session_factory()
+        job.status, job.started_at, job._started = "running", datetime.now(), time.monotonic()
+        try:
+            job.result = bg_task(db, job.mode, self.client, job=job)
+            job.status = "succeeded"
+        except job_py_JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            logger.exception("sync job %s failed", job.id)
+            job.status, job.error = "failed", f"{type(e).__name__}: {e}"
+        finally:
+            db.close()
+            job.finished_at = datetime.now()
+            with self._lock:
+                self._running.pop(job.source, None)
+            job._done.set()
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def running(self, source: str = "jhu"):
+        return self._running.get(source)
+
+
+job_py_sync_runner = job_py_SyncJobRunner()
+
+# 定时同步的间隔(秒),0表示不启用;抖动是间隔的比例,避免多个实例在同一时刻请求上游
+SYNC_INTERVAL = float(os.environ.get("CHAPTER07_SYNC_INTERVAL", 3600))
+SYNC_JITTER = 0.1
+SYNC_MAX_BACKOFF = 6 * 3600  # 连续失败时退避的最长间隔(秒)
+# 多worker部署时用来选出唯一执行同步的进程的文件锁,同一个数据库对应同一个锁文件
+SYNC_LOCK_PATH = os.path.join(
+    tempfile.gettempdir(), f"chapter07-sync-{hashlib.sha1(DATABASE_URL.encode()).hexdigest()[:8]}.lock")
+
+
+class job_py_SyncScheduler:
+    """进程内的定时同步
+        - 每隔interval秒(带随机抖动)通过runner提交一次增量同步任务,并等待它结束;
+        - uvicorn多worker部署时,只有拿到文件锁的进程执行同步,其他进程定期重试拿锁(持锁进程退出后接替它);
+        - 同步失败后按2的幂次退避,最长max_backoff秒,成功后恢复正常间隔。
+    """
+
+    def __init__(self, runner: job_py_SyncJobRunner = job_py_sync_runner, interval: float = SYNC_INTERVAL,
+                 jitter: float = SYNC_JITTER, max_backoff: float = SYNC_MAX_BACKOFF, lock_path: str = SYNC_LOCK_PATH):
+        self.runner = runner
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.lock_path = lock_path
+        self.failures = 0  # 连续失败的次数
+        self.runs = 0
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="sync-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()  # 关闭文件即释放锁
+            self._lock_file = None
+
+    def next_delay(self):
+        "下一次同步前等待的秒数: 正常为interval,连续失败时翻倍退避,再加上±jitter比例的随机抖动"
+        delay = min(self.interval * 2 ** self.failures, max(self.max_backoff, self.interval))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def acquire_lock(self):
+        "非阻塞地获取文件锁,已持有或获取成功时返回True"
+        if self._lock_file is not None:
+            return True
+        if fcntl is None:  # 没有fcntl的平台(Windows)上无法跨进程加锁,只适合单worker部署
+            self._lock_file = open(self.lock_path, "a")
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def run_once(self):
+        "提交一次增量同步并等待结束,返回任务;进程退出(stop)时取消正在运行的任务"
+        job, _ = self.runner.submit("jhu", schemas_py_SyncMode.incremental)
+        while not job.wait(0.5):
+            if self._stop.is_set():
+                job.cancel()
+                job.wait()
+                break
+        self.runs += 1
+        self.failures = self.failures + 1 if job.status == "failed" else 0
+        return job
+
+    def _loop(self):
+        # 启动后在一个抖动时间内先同步一次,让读请求尽快读到新数据
+        delay = random.uniform(0, self.jitter * self.interval)
+        while not self._stop.wait(delay):
+            if self.acquire_lock():
+                self.run_once()
+            delay = self.next_delay()
+
+
+"""
+4.4 JSON响应
+在项目结构中，下面代码可放在responses.py
+"""
+
+
+def responses_py_default(obj):
+    "标准库json不支持的类型: date/datetime按isoformat输出,和jsonable_encoder的结果一致"
+    if isinstance(obj, (date_, datetime)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def responses_py_dumps(content) -> bytes:
+    "序列化为UTF-8编码的JSON: 安装了orjson时用orjson,否则退回标准库json"
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"),
+                      default=responses_py_default).encode("utf-8")
+
+
+class responses_py_FastJSONResponse(JSONResponse):
+    """大列表接口使用的JSON响应,用responses_py_dumps序列化
+    接口直接返回这个响应对象(内容是由SQL结果组装的dict),跳过FastAPI对返回值的jsonable_encoder和response_model校验。
+    """
+
+    def render(self, content) -> bytes:
+        return responses_py_dumps(content)
+
+
+def responses_py_encode_ndjson(keys: List[str], rows) -> bytes:
+    return b"".join(responses_py_dumps(dict(zip(keys, row))) + b"\n" for row in rows)
+
+
+def responses_py_encode_csv(rows) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+def responses_py_arrow_schema():
+    "Arrow导出的列: 省份名按字典编码(每行只存一个int32下标),其它列都是定长的类型化列"
+    return pyarrow.schema([
+        ("date", pyarrow.date32()),
+        ("province", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ("confirm_num", pyarrow.int64()),
+        ("death_num", pyarrow.int64()),
+        ("cure_num", pyarrow.int64()),
+    ])
+
+
+def responses_py_iter_arrow(provinces: dict, batches: Iterable[list]):
+    """把crud_py_iter_export的每批数据编码为一个Arrow record batch,依次产出IPC流的字节块。
+    provinces是 province_id -> province_name;所有批次共用同一个省份字典,字典在流的开头只发送一次。
+    """
+    schema = responses_py_arrow_schema()
+    dictionary = pyarrow.array(list(provinces.values()), pyarrow.string())
+    positions = {province_id: i for i, province_id in enumerate(provinces)}
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    for batch in batches:
+        province_ids, _, _, dates, confirm_nums, death_nums, cure_nums = zip(*batch)
+        writer.write_batch(pyarrow.record_batch([
+            pyarrow.array(dates, pyarrow.date32()),
+            pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array([positions[i] for i in province_ids], pyarrow.int32()), dictionary),
+            pyarrow.array(confirm_nums, pyarrow.int64()),
+            pyarrow.array(death_nums, pyarrow.int64()),
+            pyarrow.array(cure_nums, pyarrow.int64()),
+        ], schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()  # 写入流结束标记;没有数据时也是一个只有schema的合法流
+    yield sink.getvalue()
+
+
+"""
+4.5 模版渲染
+在项目结构中，下面代码可放在templates.py
+"""
+
+TEMPLATES_DIRECTORY = "tutorial/templates"
+# dev: 改完模版刷新页面即可看到;prod: 模版编译之后常驻内存。和数据库的配置(DATABASE_PROFILE)相互独立
+TEMPLATES_PROFILE = os.environ.get("CHAPTER07_TEMPLATES_PROFILE", "dev")
+# prod配置下Jinja编译结果(字节码)的缓存目录,重启进程后不必重新解析、编译模版;不设置时使用系统临时目录
+TEMPLATES_BYTECODE_CACHE_DIR = os.environ.get("CHAPTER07_TEMPLATES_CACHE_DIR")
+STATIC_URL_NAMES = {"static"}  # 这些路由名的url_for结果只取决于base_url和参数,可以缓存
+STATIC_URL_CACHE_SIZE = 1024  # 最多缓存的静态文件地址个数;Host头由客户端决定,缓存必须有上限
+
+
+class templates_py_Templates(Jinja2Templates):
+    """按TEMPLATES_PROFILE配置Jinja环境的模版渲染器
+    dev: 和Jinja2Templates相同,每次取模版都检查文件是否修改,改完模版刷新页面即可看到;
+    prod: 关闭auto_reload(编译好的模版常驻内存,不再stat文件),并用文件系统字节码缓存加快进程启动后的首次编译。
+    两种配置下url_for('static', ...)的结果都按(base_url, 参数)缓存。
+    """
+
+    def __init__(self, directory: str, profile: str = TEMPLATES_PROFILE,
+                 bytecode_cache_dir: str = TEMPLATES_BYTECODE_CACHE_DIR):
+        self.profile = profile
+        self.bytecode_cache_dir = bytecode_cache_dir
+        # (base_url, 路由名, 参数) -> 地址;静态文件地址不会变化,不需要过期时间
+        self._static_urls = cache_py_LRUCache(STATIC_URL_CACHE_SIZE, float("inf"))
+        super().__init__(directory)
+
+    def get_env(self, directory: str) -> jinja2.Environment:
+        env = super().get_env(directory)
+        if self.profile == "prod":
+            env.auto_reload = False
+            env.bytecode_cache = jinja2.FileSystemBytecodeCache(self.bytecode_cache_dir)
+        url_for = env.globals["url_for"]
+
+        @jinja2.contextfunction
+        def cached_url_for(context: dict, name: str, **path_params) -> str:
+            if name not in STATIC_URL_NAMES:
+                return url_for(context, name, **path_params)
+            key = (str(context["request"].base_url), name, tuple(sorted(path_params.items())))
+            url = self._static_urls.get(key)
+            if url is None:
+                url = self._static_urls.set(key, url_for(context, name, **path_params))
+            return url
+
+        env.globals["url_for"] = cached_url_for
+        return env
+
+    def clear(self):
+        self._static_urls.clear()
+
+    def render_fragment(self, name: str, key, render_context):
+        """渲染一个页面片段,按(模版名, key, 数据版本号)缓存在cache_py_fragment_cache中。
+        render_context是无参函数,只在缓存未命中时调用,返回渲染片段需要的变量(通常在这里查询数据库)。
+        返回Markup,在外层模版中直接输出,不会被再次转义。
+        """
+        version = cache_py_data_version.value  # 先取版本号: 渲染期间有写入时,缓存项会在下次请求时失效
+        fragment = cache_py_fragment_cache.get((name, key), version)
+        if fragment is None:
+            fragment = jinja2.Markup(self.get_template(name).render(render_context()))
+            cache_py_fragment_cache.set((name, key), fragment, version)
+        return fragment
+
+
 """
 5. 业务逻辑和接口(并使用前端)  （多应用的目录结构设计:将covid19作为子应用）
 在项目结构中,可以写在main.py中
@@ -211,9 +1684,12 @@ app07 = APIRouter(
 )
 
 # app07 = APIRouter()  # 接口路由
-database_py_Base.metadata.create_all(bind=database_py_engine)  # 生成数据库和表
-templates = Jinja2Templates(
-    directory='tutorial/templates')  # 渲染模版
+# 只读接口注册在这个子路由上,使用带响应缓存的路由类;模块最后再把它添加到app07中
+app07_readonly = APIRouter(route_class=cache_py_CachedRoute)
+database_py_create_all(database_py_engine)  # 生成数据库和表,并给旧的表补建索引
+with closing(database_py_session()) as startup_db:
+    crud_py_backfill_summary(startup_db)  # 旧数据库中新建的汇总表是空的,先补齐
+templates = templates_py_Templates(directory=TEMPLATES_DIRECTORY)  # 渲染模版
 
 
 def get_db():
@@ -224,8 +1700,13 @@ def get_db():
         db.close()
 
 
+# NOTE 下面访问数据库的接口都用def而不是async def声明:
+#   SQLAlchemy的Session是同步阻塞的,在async def中直接查询会阻塞事件循环,所有并发请求只能排队执行;
+#   FastAPI会把def声明的接口函数(以及get_db这样的def依赖)放到线程池中执行,事件循环可以继续处理其他请求。
+
+
 @app07.post('/covid19/create_province', response_model=schemas_py_Read_Province)
-async def create_province(schema_create_province: schemas_py_Create_Province, db: Session = Depends(get_db)):
+def create_province(schema_create_province: schemas_py_Create_Province, db: Session = Depends(get_db)):
     # 首先判断province是否已存在
     province_db = crud_py_get_province_by_name(
         db, schema_create_province.province_name)
@@ -235,8 +1716,8 @@ async def create_province(schema_create_province: schemas_py_Create_Province, db
     return crud_py_create_province(db, schema_create_province)
 
 
-@app07.get('/covid19/get_province/{province_name}', response_model=schemas_py_Read_Province)
-async def get_province(province_name: str, db: Session = Depends(get_db)):
+@app07_readonly.get('/covid19/get_province/{province_name}', response_model=schemas_py_Read_Province)
+def get_province(province_name: str, db: Session = Depends(get_db)):
     province_model = crud_py_get_province_by_name(db, province_name)
     if province_model is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND,
@@ -244,87 +1725,315 @@ async def get_province(province_name: str, db: Session = Depends(get_db)):
     return province_model
 
 
-@app07.get('/covid19/get_provinces', response_model=schemas_py_Read_Province)
-async def get_provinces(offset: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+# 列表接口返回responses_py_FastJSONResponse: response_model只用于生成接口文档,返回值不再经过校验和jsonable_encoder
+@app07_readonly.get('/covid19/get_provinces', response_model=Union[List[schemas_py_Read_Province], schemas_py_Page_Province],
+                    response_class=responses_py_FastJSONResponse)
+def get_provinces(offset: int = 0, limit: int = Query(10, ge=1), cursor: str = None, db: Session = Depends(get_db)):
+    """传了cursor(第一页传空字符串)时使用keyset分页,返回{"items": [...], "next_cursor": ...};否则按offset分页"""
+    if cursor is not None:
+        try:
+            provinces, next_cursor = crud_py_get_provinces_page(db, cursor, limit)
+        except ValueError as e:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+        return responses_py_FastJSONResponse({"items": provinces, "next_cursor": next_cursor})
     provinces = crud_py_get_provinces(db, offset, limit)
-    return provinces
+    return responses_py_FastJSONResponse(provinces)
 
 
 @app07.post('/covid19/create_data', response_model=schemas_py_Read_Data)
-async def create_data(schema_create_data: schemas_py_Create_Data, province_name: str, db: Session = Depends(get_db)):
+def create_data(schema_create_data: schemas_py_Create_Data, province_name: str, db: Session = Depends(get_db)):
     # 找到province_id
-    province_model = crud_py_get_province_by_name(db, province_name)
-    if province_model is None:
+    province_id = crud_py_get_province_id_by_name(db, province_name)
+    if province_id is None:
         raise HTTPException(status_code=404, detail="未找到该province，请先创建它")
-    province_id = province_model.id
-    data = crud_py_create_province_data(db, schema_create_data, province_id)
-    return data
-
-
-@app07.get('/covid19/get_data')
-async def get_data(province_name: str = None, offset: int = 0, limit: int = 10, db: Session = Depends(get_db)):
-    data = crud_py_get_data(db, province_name, offset, limit)
+    try:
+        data = crud_py_create_province_data(db, schema_create_data, province_id)
+    except IntegrityError:
+        raise HTTPException(status.HTTP_409_CONFLICT, detail="data already exists")
     return data
 
 
-@app07.get("/covid19/", description="covid19应用的首页")  # 前后端不分离
+# 批量写入一次最多接受的条目数和请求体字节数
+CREATE_DATA_BATCH_MAX_ITEMS = 100000
+CREATE_DATA_BATCH_MAX_BYTES = 32 * 1024 * 1024
+
+
+async def read_data_batch(request: Request):
+    """读取批量写入的请求体,返回(是否为NDJSON, 请求体)。
+    这里只在事件循环中接收字节,超过CREATE_DATA_BATCH_MAX_BYTES时直接返回413;解析和校验是CPU密集的,放在def接口中由线程池执行。
+    """
+    too_large = HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                              detail=f"request body is larger than {CREATE_DATA_BATCH_MAX_BYTES} bytes")
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > CREATE_DATA_BATCH_MAX_BYTES:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():  # 没有Content-Length(分块传输)时边收边检查大小
+        size += len(chunk)
+        if size > CREATE_DATA_BATCH_MAX_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    ndjson = request.headers.get("content-type", "").split(";")[0].strip() in ("application/x-ndjson",
+                                                                              "application/jsonl")
+    return ndjson, b"".join(chunks)
+
+
+def parse_data_batch(body: bytes, ndjson: bool = False):
+    """解析批量写入的请求体: JSON数组,或者每行一个JSON对象的NDJSON。
+    返回(通过校验的条目[(序号, 数据)], 错误列表)。
+    """
+    if ndjson:
+        objects = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                objects.append(json.loads(line))
+            except ValueError as e:
+                objects.append(e)
+    else:
+        try:
+            objects = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"invalid JSON: {e}")
+        if not isinstance(objects, list):
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="expected a JSON array")
+    if len(objects) > CREATE_DATA_BATCH_MAX_ITEMS:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"at most {CREATE_DATA_BATCH_MAX_ITEMS} items per batch")
+    items, errors = [], []
+    for index, obj in enumerate(objects):
+        if isinstance(obj, ValueError):
+            errors.append({"index": index, "detail": f"invalid JSON: {obj}"})
+            continue
+        try:
+            items.append((index, schemas_py_Create_Data_Item.parse_obj(obj)))
+        except ValidationError as e:
+            errors.append({"index": index, "detail": e.errors()})
+    return items, errors
+
+
+@app07.post('/covid19/create_data/batch')
+def create_data_batch(batch=Depends(read_data_batch), db: Session = Depends(get_db)):
+    """批量写入疫情数据(可以包含多个省份),用于回填历史数据。
+    请求体是JSON数组,或者每行一个JSON对象的NDJSON(Content-Type: application/x-ndjson),每个条目包含province_name、date、
+    confirm_num、death_num、cure_num。有问题的条目在errors中按序号(从0开始)返回,其余条目在一个事务中写入。
+    """
+    items, errors = parse_data_batch(body=batch[1], ndjson=batch[0])
+    received = len(items) + len(errors)
+    try:
+        inserted, write_errors = crud_py_create_data_batch(db, items)
+    except IntegrityError:
+        # 检查之后、写入之前有其它请求写入了相同的数据,整个批次已回滚,可以重试
+        raise HTTPException(status.HTTP_409_CONFLICT, detail="conflicting concurrent write, batch rolled back")
+    errors = sorted(errors + write_errors, key=lambda error: error["index"])
+    return {"received": received, "inserted": inserted, "errors": errors}
+
+
+@app07_readonly.get('/covid19/get_data', response_class=responses_py_FastJSONResponse)
+def get_data(province_name: str = None, offset: int = 0, limit: int = Query(10, ge=1), cursor: str = None,
+             db: Session = Depends(get_db)):
+    """传了cursor(第一页传空字符串)时使用keyset分页,返回{"items": [...], "next_cursor": ...};否则按offset分页"""
+    if cursor is not None:
+        try:
+            data, next_cursor = crud_py_get_data_page(db, province_name, cursor, limit)
+        except ValueError as e:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+        return responses_py_FastJSONResponse({"items": data, "next_cursor": next_cursor})
+    data = crud_py_get_data_rows(db, province_name, offset, limit)
+    return responses_py_FastJSONResponse(data)
+
+
+@app07_readonly.get('/covid19/stats/daily', response_model=List[schemas_py_Daily_Stats])
+def get_daily_stats(province_name: str = None, start_date: date_ = None, end_date: date_ = None,
+                    window: int = Query(SUMMARY_WINDOW, ge=1, le=90, description="滑动平均的天数"),
+                    db: Session = Depends(get_db)):
+    """按日聚合的统计: 不传province_name时是全国合计;包含日增量和日增量的window日滑动平均"""
+    return crud_py_get_daily_stats(db, province_name, start_date, end_date, window)
+
+
+@app07_readonly.get('/covid19/stats/latest', response_model=List[schemas_py_Latest_Data])
+def get_latest_data(db: Session = Depends(get_db)):
+    """每个省份最新一天的数据"""
+    return crud_py_get_latest_data(db)
+
+
+@app07.get('/covid19/stats/check_summary')
+def check_summary(db: Session = Depends(get_db)):
+    """检查汇总表和全量重算的结果是否一致(只读);修复用POST /covid19/stats/repair_summary"""
+    mismatches = crud_py_check_summary(db)
+    return {"consistent": not mismatches, "mismatch_count": len(mismatches), "mismatches": mismatches[:100],
+            "repaired": False}
+
+
+@app07.post('/covid19/stats/repair_summary')
+def repair_summary(db: Session = Depends(get_db)):
+    """检查汇总表,发现不一致时全量重算汇总表"""
+    mismatches = crud_py_check_summary(db)
+    if mismatches:
+        try:
+            crud_py_refresh_summary(db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        cache_py_data_version.bump()
+    return {"consistent": not mismatches, "mismatch_count": len(mismatches), "mismatches": mismatches[:100],
+            "repaired": bool(mismatches)}
+
+
+@app07.get('/covid19/metrics/province_cache')
+def province_cache_metrics():
+    "省份缓存的命中数、未命中数和当前大小"
+    return cache_py_province_cache.stats()
+
+
+def get_session_factory():
+    "数据库会话工厂的依赖项: 流式响应在请求处理函数返回之后才执行,需要自己创建和关闭会话;测试时可以替换"
+    return database_py_session
+
+
+# 导出接口注册在app07上: 响应体可能很大,不进入响应缓存
+@app07.get('/covid19/export')
+def export_data(format: schemas_py_ExportFormat = schemas_py_ExportFormat.ndjson, province_name: str = None,
+                start_date: date_ = None, end_date: date_ = None, session_factory=Depends(get_session_factory)):
+    """导出疫情数据(按省份和日期排序),可以按省份和日期范围过滤。
+    边查询边发送: 不等全部数据查询完就开始响应,整个导出过程的内存占用是常数。
+    format=arrow时输出Arrow IPC流(date、province、confirm_num、death_num、cure_num),可以直接读入pandas/polars等数据框。
+    """
+    if format == schemas_py_ExportFormat.arrow and pyarrow is None:
+        raise HTTPException(status.HTTP_501_NOT_IMPLEMENTED, detail="arrow export requires pyarrow")
+    province_id = None
+    if province_name is not None:
+        db = session_factory()
+        try:
+            province_id = crud_py_get_province_id_by_name(db, province_name)
+        finally:
+            db.close()
+        if province_id is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail="province not found！")
+
+    def generate():
+        # def生成器由starlette放到线程池中迭代,查询不会阻塞事件循环;客户端断开时生成器被关闭,会话随之关闭
+        db = session_factory()
+        try:
+            if format == schemas_py_ExportFormat.arrow:
+                provinces = dict(db.query(models_py_Province.id, models_py_Province.province_name).order_by(
+                    models_py_Province.id))
+                yield from responses_py_iter_arrow(
+                    provinces, crud_py_iter_export(db, province_id, start_date, end_date, EXPORT_BATCH_SIZE))
+                return
+            if format == schemas_py_ExportFormat.csv:
+                yield responses_py_encode_csv([EXPORT_KEYS])  # 先发送表头,客户端立刻收到响应
+            for batch in crud_py_iter_export(db, province_id, start_date, end_date, EXPORT_BATCH_SIZE):
+                if format == schemas_py_ExportFormat.csv:
+                    yield responses_py_encode_csv(batch)
+                else:
+                    yield responses_py_encode_ndjson(EXPORT_KEYS, batch)
+        finally:
+            db.close()
+
+    media_type = {schemas_py_ExportFormat.ndjson: "application/x-ndjson",
+                  schemas_py_ExportFormat.csv: "text/csv; charset=utf-8",
+                  schemas_py_ExportFormat.arrow: "application/vnd.apache.arrow.stream"}[format]
+    return StreamingResponse(generate(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="covid19.{format.value}"'})
+
+
+@app07_readonly.get("/covid19/", description="covid19应用的首页")  # 前后端不分离
 def covid19(request: Request, province_name: str = None, offset: int = 0, limit: int = 10, db: Session = Depends(get_db)):
-    data = crud_py_get_data(db, province_name, offset, limit)
+    # 表格部分单独渲染并缓存,数据未变化时不查询数据库、不再逐行渲染
+    table_body = templates.render_fragment("home_table.html", (province_name, offset, limit), lambda: {
+        "data": crud_py_get_data(db, province_name, offset, limit)})
     return templates.TemplateResponse(
         name="home.html",  # html文件
         context={"request": request,
-                 "data": data,
+                 "table_body": table_body,
                  # 点击之后传递一个接口地址的常量（该接口用于同步数据）
                  "sync_data_url": "/chapter07/appstore/covid19/sync_coronavirus_data/jhu",
                  },
     )
 
 
-def bg_task(url: HttpUrl, db: Session):
-    """这里注意一个坑，不要在后台任务的参数中db: Session = Depends(get_db)这样导入依赖"""
-
-    province_data = requests.get(
-        url=f"{url}?source=jhu&country_code=CN&timelines=false")
+def get_sync_runner():
+    "同步任务执行器的依赖项,测试时可以替换"
+    return job_py_sync_runner
+
+
+def bg_task(db: Session, mode: schemas_py_SyncMode = schemas_py_SyncMode.incremental,
+            client: upstream_py_Client = upstream_py_client, chunk_size: int = SYNC_CHUNK_SIZE,
+            job: job_py_SyncJob = None):
+    """从上游同步数据,返回 {"inserted", "updated", "unchanged"}。
+    这里注意一个坑，不要在后台任务的参数中db: Session = Depends(get_db)这样导入依赖: 请求结束后get_db会关闭这个Session,
+    所以由job_py_SyncJobRunner为每个任务单独创建Session。传入job时记录进度,并支持取消。
+    """
+    # 全量同步不带条件头,总是拿到完整数据
+    responses = client.fetch_locations(conditional=mode != schemas_py_SyncMode.full)
+    if responses is None:
+        logger.info("coronavirus data not modified, skip sync")
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+    province_data, coronavirus_data = responses
+    # 拿到响应之后立即进入try: 任务被取消、上游数据不是合法JSON时也要关闭流式响应,把连接还给连接池
+    try:
+        if job is not None:
+            job.check_cancelled()
 
-    if 200 == province_data.status_code:
-        db.query(models_py_Province).delete()  # 同步数据前先清空原有的数据
-        for location in province_data.json()["locations"]:
-            province_schema = {
+        provinces = [
+            {
                 "province_name": location["province"],
                 "country_name": location["country"],
                 "country_code": "CN",
                 "country_population": location["country_population"]
             }
-            crud_py_create_province(
-                db, province=schemas_py_Create_Province(**province_schema))
-    coronavirus_data = requests.get(
-        url=f"{url}?source=jhu&country_code=CN&timelines=true")
-
-    if 200 == coronavirus_data.status_code:
-        db.query(models_py_Data).delete()
-        for province in coronavirus_data.json()["locations"]:
-            province_model = crud_py_get_province_by_name(
-                db, province_name=province["province"])
-            for date, confirmed in province["timelines"]["confirmed"]["timeline"].items():
-                data = {
-                    # 把'2020-12-31T00:00:00Z' 变成 ‘2020-12-31’
-                    "date": date.split("T")[0],
-                    "confirme_num": confirmed,
-                    "death_num": province["timelines"]["deaths"]["timeline"][date],
-                    "cure_num": 0  # 每个城市每天有多少人痊愈，这种数据没有
-                }
-                # 这个city_id是city表中的主键ID，不是coronavirus_data数据里的ID
-                crud_py_create_province_data(db, schemas_py_Create_Data(
-                    **data), province_id=province_model.id)
+            for location in province_data.json()["locations"]
+        ]
+        # 生成器流水线: 下载 -> 逐个解析location -> 逐行生成data -> 分批写库,内存占用与数据总量无关
+        locations = upstream_py_iter_locations(coronavirus_data)
+        if job is not None:
+            locations = job.track(locations, len(provinces))
+        if mode == schemas_py_SyncMode.full:
+            stats = {"inserted": crud_py_reload_coronavirus_data(db, provinces, locations, chunk_size),
+                     "updated": 0, "unchanged": 0}
+        else:
+            stats = crud_py_sync_coronavirus_data(db, provinces, locations, chunk_size)
+    finally:
+        coronavirus_data.close()
+    client.remember(province_data, coronavirus_data)
+    logger.info("coronavirus data synced (%s): %s", mode.value, stats)
+    return stats
 
 
 @app07.get("/covid19/sync_coronavirus_data/jhu")
-def sync_coronavirus_data(background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    """从Johns Hopkins University同步COVID-19数据"""
-    background_tasks.add_task(
-        bg_task, "https://coronavirus-tracker-api.herokuapp.com/v2/locations", db)
-    return {"message": "正在后台同步数据..."}
-
+def sync_coronavirus_data(mode: schemas_py_SyncMode = schemas_py_SyncMode.incremental,
+                          runner: job_py_SyncJobRunner = Depends(get_sync_runner)):
+    """从Johns Hopkins University同步COVID-19数据, mode=incremental只同步变化的数据, mode=full清空后全量同步。
+    已有同步任务在运行时不会再启动新的任务,而是返回正在运行的任务。
+    """
+    job, created = runner.submit("jhu", mode)
+    message = "正在后台同步数据..." if created else "已有同步任务正在运行..."
+    return {"message": message, "job_id": job.id, "coalesced": not created}
+
+
+@app07.get("/covid19/sync_jobs/{job_id}")
+def get_sync_job(job_id: str, runner: job_py_SyncJobRunner = Depends(get_sync_runner)):
+    """同步任务的状态: 已处理的行数、吞吐量(行/秒)和预计剩余时间(秒)"""
+    job = runner.get(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="sync job not found！")
+    return job.to_dict()
+
+
+@app07.post("/covid19/sync_jobs/{job_id}/cancel")
+def cancel_sync_job(job_id: str, runner: job_py_SyncJobRunner = Depends(get_sync_runner)):
+    """取消同步任务,已经写入的数据随事务回滚"""
+    job = runner.get(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="sync job not found！")
+    job.cancel()
+    return job.to_dict()
+
+
+app07.include_router(app07_readonly)
 
 """
 6. 将该子应用添加到主应用中运行
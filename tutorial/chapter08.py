@@ -2,9 +2,13 @@
 # -*- coding:utf-8 -*-
 # __author__ = '__Jack__'
 
-from typing import Optional
+import time
+from bisect import bisect_left
+from typing import Callable, Optional
 
 from fastapi import APIRouter, BackgroundTasks, Depends
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Mount
 
 app08 = APIRouter()
 
@@ -12,6 +16,199 @@ app08 = APIRouter()
 
 # 注：带yield的依赖的退出部分的代码 和 后台任务 会在中间件之后运行
 
+"""
+Middleware 指标中间件
+run.py中注册的MetricsMiddleware是一个纯ASGI中间件(没有用@app.middleware('http')/BaseHTTPMiddleware,
+它们会为每个请求创建Request/Response对象和额外的任务),记录:
+    http_request_duration_seconds: 按 方法、路由模板(如/chapter07/appstore/covid19/get_data,而不是带参数的实际路径)、状态码 的延迟直方图,
+        用单调时钟time.perf_counter计时;同时保留X-Process-Time响应头;
+    http_requests_in_flight: 正在处理的请求数;
+    http_request_size_bytes / http_response_size_bytes: 请求体和响应体大小的直方图。
+指标由metrics_registry.endpoint以Prometheus文本格式输出,其它模块的统计(缓存命中率等)通过register_collector接入。
+所有计数只在事件循环线程中修改,不需要加锁,每个请求只多几次字典查找和加法。
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)  # 秒
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)  # 字节
+UNMATCHED_ROUTE = "<unmatched>"  # 没有匹配到路由的请求(如404)归为一类,避免按实际路径产生无限多的标签
+
+
+class Histogram:
+    """按标签分组的直方图: 标签值(元组) -> [各桶计数..., +Inf桶计数, 总和, 个数]"""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def get_series(self, label_values: tuple):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 3)
+        return series
+
+    def observe(self, label_values: tuple, value: float):
+        series = self.get_series(label_values)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self.series.items()):
+            labels = ",".join(f'{k}="{escape_label(v)}"' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """指标注册表: 中间件写入的直方图和gauge,以及注册进来的collector"""
+
+    def __init__(self, latency_buckets: tuple = LATENCY_BUCKETS, size_buckets: tuple = SIZE_BUCKETS):
+        self.duration = Histogram("http_request_duration_seconds", "HTTP request latency",
+                                  ("method", "route", "status"), latency_buckets)
+        self.request_size = Histogram("http_request_size_bytes", "HTTP request body size",
+                                      ("method", "route"), size_buckets)
+        self.response_size = Histogram("http_response_size_bytes", "HTTP response body size",
+                                       ("method", "route", "status"), size_buckets)
+        self.in_flight = 0
+        self.collectors = []
+        self._series = {}  # (method, route, status) -> 三个直方图中对应的序列,每个请求只查一次字典
+
+    def observe_request(self, method: str, route: str, status: int, elapsed: float, request_size: int, response_size: int):
+        key = (method, route, status)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = (self.duration.get_series(key), self.request_size.get_series(key[:2]),
+                                          self.response_size.get_series(key))
+        duration, request, response = series
+        duration[bisect_left(self.duration.buckets, elapsed)] += 1
+        duration[-2] += elapsed
+        duration[-1] += 1
+        request[bisect_left(self.request_size.buckets, request_size)] += 1
+        request[-2] += request_size
+        request[-1] += 1
+        response[bisect_left(self.response_size.buckets, response_size)] += 1
+        response[-2] += response_size
+        response[-1] += 1
+
+    def register_collector(self, collector: Callable):
+        """collector()返回[(指标名, 类型, 说明, [(标签字典, 值), ...]), ...],每次输出指标时调用"""
+        self.collectors.append(collector)
+
+    def register_stats(self, prefix: str, stats: Callable, help: str, counters: tuple = ("hits", "misses")):
+        """把一个返回统计字典的函数(如cache_py_province_cache.stats)注册为collector:
+        counters中的键输出为{prefix}_{key}_total计数器,其余的键输出为{prefix}_{key} gauge"""
+
+        def collector():
+            return [(f"{prefix}_{key}_total" if key in counters else f"{prefix}_{key}",
+                     "counter" if key in counters else "gauge", f"{help} {key}", [({}, value)])
+                    for key, value in stats().items()]
+
+        self.register_collector(collector)
+
+    def render(self):
+        "输出Prometheus文本格式"
+        lines = ["# HELP http_requests_in_flight HTTP requests currently being processed",
+                 "# TYPE http_requests_in_flight gauge",
+                 f"http_requests_in_flight {self.in_flight}"]
+        for histogram in (self.duration, self.request_size, self.response_size):
+            lines.extend(histogram.render())
+        for collector in self.collectors:
+            for name, type_, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type_}")
+                for labels, value in samples:
+                    labels = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def endpoint(self, request):
+        """/metrics接口, 用法: app.add_route('/metrics', metrics_registry.endpoint, include_in_schema=False)"""
+        return PlainTextResponse(self.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+metrics_registry = MetricsRegistry()
+
+
+class MetricsMiddleware:
+    """纯ASGI指标中间件, 用法: app.add_middleware(MetricsMiddleware, registry=metrics_registry)"""
+
+    def __init__(self, app, registry: MetricsRegistry = metrics_registry):
+        self.app = app
+        self.registry = registry
+        self._templates = {}  # endpoint -> 路由模板,第一次遇到某个endpoint时从app.routes生成
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        registry = self.registry
+        start = time.perf_counter()
+        sizes = [0, 0]  # 请求体、响应体字节数
+        status = [500]  # 应用没有发出响应就抛出异常时记为500
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes[0] += len(message.get("body", b""))
+            return message
+
+        # 请求体大小优先取Content-Length,只有分块传输(没有Content-Length)的请求才包装receive逐块计数
+        chunked = False
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                sizes[0] = int(value)
+                break
+            if name == b"transfer-encoding":
+                chunked = True
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                # 和原来的add_process_time_header一样,X-Process-Time是到开始发送响应为止的耗时(秒)
+                process_time = b"%.6f" % (time.perf_counter() - start)
+                headers = message.setdefault("headers", [])
+                if not isinstance(headers, list):
+                    headers = message["headers"] = list(headers)
+                headers.append((b"x-process-time", process_time))
+            elif message["type"] == "http.response.body":
+                sizes[1] += len(message.get("body", b""))
+            await send(message)
+
+        registry.in_flight += 1
+        try:
+            await self.app(scope, receive_wrapper if chunked else receive, send_wrapper)
+        finally:
+            registry.in_flight -= 1
+            elapsed = time.perf_counter() - start
+            # 路由匹配之后starlette会把匹配到的endpoint写回scope
+            registry.observe_request(scope["method"], self.route_template(scope), status[0], elapsed, sizes[0], sizes[1])
+
+    def route_template(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        template = self._templates.get(endpoint)
+        if template is None:
+            for route in scope["app"].routes:
+                path = route.path + "/{path}" if isinstance(route, Mount) else route.path
+                self._templates.setdefault(getattr(route, "endpoint", None) or getattr(route, "app", None), path)
+            template = self._templates.setdefault(endpoint, UNMATCHED_ROUTE)
+        return template
+
+
 """【见run.py】CORS (Cross-Origin Resource Sharing) 跨源资源共享"""
 
 # 域的概念：协议+域名+端口
@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = '__Jack__'
+
+import threading
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from jose import JWTError, jwt
+from sqlalchemy import event
+
+from tutorial import chapter06
+
+"""Testing 第六章的测试用例"""
+
+
+@pytest.fixture
+def verifier(monkeypatch):
+    "每个用例使用独立的token校验器,缓存和撤销记录互不影响"
+    verifier = chapter06.TokenVerifier_jwt()
+    monkeypatch.setattr(chapter06, "token_verifier_jwt", verifier)
+    return verifier
+
+
+@pytest.fixture
+def client(verifier):
+    app = FastAPI()
+    app.include_router(chapter06.app06, prefix='/chapter06')
+    return TestClient(app)
+
+
+def login(client, username="jia", password="jia_secret"):
+    response = client.post("/chapter06/jwt/token", data={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def make_token(exp, sub="jia", iat=None):
+    claims = {"sub": sub, "exp": exp}
+    if iat is not None:
+        claims["iat"] = iat
+    return jwt.encode(claims, chapter06.JWT_KEY, algorithm=chapter06.JWT_ALGORITHMS)
+
+
+def test_token_verifier_caches_until_exp(client, verifier, monkeypatch):
+    headers = login(client)
+    decoded = []
+    decode = chapter06.jwt.decode
+    monkeypatch.setattr(chapter06.jwt, "decode", lambda *args, **kwargs: decoded.append(1) or decode(*args, **kwargs))
+
+    for _ in range(3):
+        response = client.get("/chapter06/jwt/users/me", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["username"] == "jia"
+        assert "hashed_password" not in response.json()
+    # 只有第一次请求校验了签名
+    assert len(decoded) == 1
+    assert verifier.stats()["hits"] == 2 and verifier.stats()["misses"] == 1
+
+    # 到了exp缓存就不再生效,重新校验签名和有效期
+    verifier._clock = lambda: 9999999999
+    client.get("/chapter06/jwt/users/me", headers=headers)
+    assert len(decoded) == 2
+
+
+def test_token_verifier_rejects_invalid_and_expired(verifier):
+    with pytest.raises(JWTError):
+        verifier.verify("not-a-token")
+    with pytest.raises(JWTError):
+        verifier.verify(make_token(exp=1))
+    with pytest.raises(JWTError):
+        verifier.verify(make_token(exp=9999999999, sub="nobody"))
+    assert verifier.stats()["failures"] == 3 and verifier.stats()["size"] == 0
+
+
+def test_token_without_exp(client, verifier):
+    token = jwt.encode({"sub": "jia"}, chapter06.JWT_KEY, algorithm=chapter06.JWT_ALGORITHMS)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/chapter06/jwt/users/me", headers=headers).status_code == 200
+    # 没有exp时只缓存JWT_CACHE_TTL秒
+    verifier._clock = lambda: 9999999999
+    assert client.get("/chapter06/jwt/users/me", headers=headers).status_code == 200
+    assert verifier.stats()["misses"] == 2
+    assert client.post("/chapter06/jwt/logout", headers=headers).status_code == 200
+    assert client.get("/chapter06/jwt/users/me", headers=headers).status_code == 401
+
+
+def test_token_verifier_lru(verifier):
+    verifier.maxsize = 2
+    tokens = [make_token(exp=9999999999, iat=i) for i in range(3)]
+    for token in tokens:
+        verifier.verify(token)
+    assert verifier.stats()["size"] == 2
+    verifier.verify(tokens[2])
+    assert verifier.stats()["hits"] == 1
+    verifier.verify(tokens[0])  # 最早的已被淘汰
+    assert verifier.stats()["misses"] == 4
+
+
+def test_token_revocation(client, verifier):
+    headers = login(client)
+    assert client.get("/chapter06/jwt/users/me", headers=headers).status_code == 200
+    assert client.post("/chapter06/jwt/logout", headers=headers).status_code == 200
+    # 已缓存的token被撤销后立即失效
+    assert client.get("/chapter06/jwt/users/me", headers=headers).status_code == 401
+
+    # 按用户撤销: 之前签发的token全部失效
+    token = make_token(exp=9999999999, iat=1)
+    assert verifier.verify(token).username == "jia"
+    verifier.revoke_user("jia")
+    with pytest.raises(JWTError):
+        verifier.verify(token)
+    assert verifier.stats()["revocations"] == 2
+
+
+def test_user_store_change_drops_cached_principal(client, verifier, tmp_path, monkeypatch):
+    store = chapter06.create_user_store(chapter06.UserInDB_jwt, chapter06.fake_users_db_jwt.values(), "users_jwt",
+                                        f"sqlite:///{tmp_path / 'users.sqlite3'}",
+                                        on_change=chapter06.forget_principals_jwt)
+    monkeypatch.setattr(chapter06, "user_store_jwt", store)
+    headers = login(client)
+    assert client.get("/chapter06/jwt/users/me", headers=headers).status_code == 200
+    assert verifier.stats()["size"] == 1
+
+    # 禁用用户后缓存的用户模型立即失效,token本身没有被撤销
+    store.add(dict(chapter06.fake_users_db_jwt["jia"], activate=False))
+    assert verifier.stats()["size"] == 0
+    response = client.get("/chapter06/jwt/users/me", headers=headers)
+    assert response.status_code == 401
+    assert verifier.stats()["revocations"] == 0
+
+
+def test_login_verifies_secret_in_bounded_pool(client, monkeypatch):
+    hasher = chapter06.SecretHasher_jwt(workers=1, queue=0)
+    monkeypatch.setattr(chapter06, "secret_hasher_jwt", hasher)
+    started, release, threads = threading.Event(), threading.Event(), []
+    verify = chapter06.verify_hashed_secret
+
+    def blocking_verify(*args):
+        threads.append(threading.current_thread().name)
+        started.set()
+        release.wait(5)
+        return verify(*args)
+
+    monkeypatch.setattr(chapter06, "verify_hashed_secret", blocking_verify)
+    results = []
+    first = threading.Thread(target=lambda: results.append(login(client)))
+    first.start()
+    assert started.wait(5)
+    # 唯一的名额被占用时,新的登录直接返回429
+    response = client.post("/chapter06/jwt/token", data={"username": "jia", "password": "jia_secret"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    release.set()
+    first.join(5)
+    assert len(results) == 1
+    assert threads[0].startswith("secret-hasher")
+    assert hasher.stats() == {"in_flight": 0, "rejected": 1, "capacity": 1}
+    # 名额释放后可以继续登录,密码错误仍然是400
+    response = client.post("/chapter06/jwt/token", data={"username": "jia", "password": "wrong"})
+    assert response.status_code == 400
+
+
+def make_users(count):
+    return ({
+        "username": f"user-{i}",
+        "email": f"user-{i}@example.com",
+        "gender": "female",
+        "hashed_password": chapter06.fake_users_db_jwt["jia"]["hashed_password"],
+        "activate": True,
+    } for i in range(count))
+
+
+@pytest.fixture
+def sql_user_store(tmp_path):
+    url = f"sqlite:///{tmp_path / 'users.sqlite3'}"
+    return chapter06.create_user_store(chapter06.UserInDB_jwt, chapter06.fake_users_db_jwt.values(), "users_jwt", url)
+
+
+def test_sql_user_store(sql_user_store):
+    store = sql_user_store
+    assert store.bulk_import(make_users(2500), chunk_size=1000) == 2500
+    statements = []
+    event.listen(store.engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+
+    user = store.get("user-1234")
+    assert user.email == "user-1234@example.com" and user.gender == chapter06.Gender.female
+    # 读穿透缓存: 第二次读取不再查询数据库
+    assert store.get("user-1234") is user
+    assert len(statements) == 1
+    assert store.get("nobody") is None
+    assert store.stats()["hits"] == 1
+
+    # 覆盖导入会失效缓存
+    store.add(dict(user.dict(), activate=False))
+    assert store.get("user-1234").activate is False
+
+    with pytest.raises(TypeError):
+        chapter06.UserStore(chapter06.UserInDB)  # 抽象接口不能直接实例化
+
+    # 按username查询走唯一索引,不做全表扫描
+    with store.engine.connect() as conn:
+        plan = " ".join(str(row[-1]) for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM users_jwt WHERE username = 'user-1'"))
+    assert "USING INDEX" in plan
+
+
+def test_login_with_sql_user_store(client, sql_user_store, monkeypatch):
+    monkeypatch.setattr(chapter06, "user_store_jwt", sql_user_store)
+    user_store = chapter06.create_user_store(chapter06.UserInDB, chapter06.fake_users_db.values(), "users",
+                                             str(sql_user_store.engine.url))
+    monkeypatch.setattr(chapter06, "user_store", user_store)
+    sql_user_store.bulk_import(make_users(10))
+    threads = []
+    for store in (sql_user_store, user_store):
+        monkeypatch.setattr(store, "get", lambda username, get=store.get: threads.append(
+            threading.current_thread()) or get(username))
+    # user-3的密码哈希和jia相同
+    headers = login(client, username="user-3")
+    response = client.get("/chapter06/jwt/users/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"username": "user-3", "email": "user-3@example.com",
+                               "gender": "female", "activate": True}
+    response = client.post("/chapter06/jwt/token", data={"username": "nobody", "password": "jia_secret"})
+    assert response.status_code == 400
+
+    # Bearer-token方式同样从用户存储读取
+    response = client.post("/chapter06/token", data={"username": "jia", "password": "jia_secret"})
+    token = response.json()["access_token"]
+    response = client.get("/chapter06/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.json()["username"] == "jia"
+    # 阻塞的数据库查询都在线程池中执行,不在事件循环线程中
+    assert len(threads) >= 4 and threading.main_thread() not in threads
+
+
+def test_auth_principal_shared_across_dependency_chain(client, verifier, monkeypatch):
+    headers = login(client)
+    seen = []
+    monkeypatch.setattr(chapter06.AuthPrincipal, "to_response",
+                        lambda self: seen.append(self) or chapter06.JSONResponse(self._asdict()))
+    client.get("/chapter06/jwt/users/me", headers=headers)
+    client.get("/chapter06/jwt/users/me", headers=headers)
+    # 同一个token的请求共享同一个不可变principal,不再重新构造用户模型
+    assert seen[0] is seen[1]
+    assert isinstance(seen[0], chapter06.AuthPrincipal) and not hasattr(seen[0], "__dict__")
+    with pytest.raises(AttributeError):
+        seen[0].activate = False
+
+    response = client.get("/chapter06/users/me", headers={"Authorization": "Bearer jia_token"})
+    assert response.json()["email"] == "jia@qq.com" and "hashed_password" not in response.json()
+    # 响应模型仍然出现在OpenAPI文档中
+    assert {route.response_model for route in chapter06.app06.routes if getattr(route, "path", "").endswith("users/me")} == {
+        chapter06.User, chapter06.User_jwt}
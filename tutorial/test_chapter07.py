@@ -0,0 +1,810 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = '__Jack__'
+
+import json
+import logging
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi import FastAPI
+from fastapi.encoders import jsonable_encoder
+from fastapi.staticfiles import StaticFiles
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from tutorial import chapter07
+
+"""Testing 第七章的测试用例（每个用例使用独立的临时sqlite数据库）"""
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    "进程内缓存是模块级的,每个用例的数据库不同,用例之间要清空"
+    chapter07.cache_py_province_cache.invalidate()
+    chapter07.cache_py_response_cache.clear()
+    chapter07.cache_py_fragment_cache.clear()
+    chapter07.templates.clear()
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = chapter07.database_py_create_engine(f"sqlite:///{tmp_path / 'chapter07.sqlite3'}", profile="prod")
+    chapter07.database_py_create_all(engine)
+    return sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+
+@pytest.fixture
+def client(session_factory):
+    app = FastAPI()
+    app.add_middleware(chapter07.database_py_QueryStatsMiddleware)
+    app.mount(path='/static', app=StaticFiles(directory='./tutorial/static'), name='static')
+    app.include_router(chapter07.app07, prefix='/chapter07')
+
+    def get_test_db():
+        session = session_factory()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    app.dependency_overrides[chapter07.get_db] = get_test_db
+    app.dependency_overrides[chapter07.get_session_factory] = lambda: session_factory
+    return TestClient(app)
+
+
+@pytest.fixture
+def statements(session_factory):
+    "记录测试数据库上执行过的SQL语句"
+    executed = []
+    engine = session_factory.kw["bind"]
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: executed.append(statement))
+    return executed
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def make_location(province, timeline):
+    "构造一个上游(JHU)格式的location, timeline为 {'2020-01-01': (确诊数, 死亡数)}"
+    return {
+        "province": province,
+        "country": "China",
+        "country_population": 1400000000,
+        "timelines": {
+            "confirmed": {"timeline": {f"{d}T00:00:00Z": c for d, (c, _) in timeline.items()}},
+            "deaths": {"timeline": {f"{d}T00:00:00Z": n for d, (_, n) in timeline.items()}},
+        },
+    }
+
+
+def make_province(location):
+    return {
+        "province_name": location["province"],
+        "country_name": location["country"],
+        "country_code": "CN",
+        "country_population": location["country_population"],
+    }
+
+
+def test_reload_coronavirus_data_in_chunks(db):
+    locations = [make_location(f"p{i}", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 11)})
+                 for i in range(5)]
+    count = chapter07.crud_py_reload_coronavirus_data(
+        db, [make_province(loc) for loc in locations], locations, chunk_size=7)
+    assert count == 50
+    assert db.query(chapter07.models_py_Data).count() == 50
+    row = chapter07.crud_py_get_data(db, province_name="p3")[-1]
+    assert row.date == date(2020, 1, 10) and row.confirm_num == 10
+
+
+def test_reload_coronavirus_data_is_atomic(db):
+    old = [make_location("old", {"2020-01-01": (1, 0)})]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in old], old)
+
+    # timelines里出现了province表中不存在的省份,写到一半出错,应整体回滚
+    new = [make_location("new", {"2020-01-02": (2, 0)}), make_location("missing", {"2020-01-02": (2, 0)})]
+    with pytest.raises(KeyError):
+        chapter07.crud_py_reload_coronavirus_data(db, [make_province(new[0])], new, chunk_size=1)
+    assert [p.province_name for p in db.query(chapter07.models_py_Province)] == ["old"]
+    assert db.query(chapter07.models_py_Data).count() == 1
+
+
+def test_incremental_sync_only_writes_delta(db):
+    timeline = {f"2020-01-{d:02d}": (d, 0) for d in range(1, 21)}
+    locations = [make_location("p1", timeline), make_location("p2", timeline)]
+    provinces = [make_province(loc) for loc in locations]
+    stats = chapter07.crud_py_sync_coronavirus_data(db, provinces, locations)
+    assert stats == {"inserted": 40, "updated": 0, "unchanged": 0}
+
+    # 第二次同步: p1新增一天并修正了最近一天的数据, p2没有变化
+    timeline_p1 = dict(timeline, **{"2020-01-20": (100, 1), "2020-01-21": (21, 0)})
+    locations = [make_location("p1", timeline_p1), make_location("p2", timeline)]
+    stats = chapter07.crud_py_sync_coronavirus_data(db, provinces, locations)
+    assert stats == {"inserted": 1, "updated": 1, "unchanged": 39}
+    assert db.query(chapter07.models_py_Data).count() == 41
+    rows = {row.date: row for row in chapter07.crud_py_get_data(db, province_name="p1")}
+    assert (rows[date(2020, 1, 20)].confirm_num, rows[date(2020, 1, 20)].death_num) == (100, 1)
+    assert rows[date(2020, 1, 21)].confirm_num == 21
+
+
+def test_incremental_sync_fills_missing_dates_in_window(db):
+    # 第一次同步时上游缺少1月8日
+    timeline = {f"2020-01-{d:02d}": (d, 0) for d in range(1, 11)}
+    locations = [make_location("p1", {k: v for k, v in timeline.items() if k != "2020-01-08"})]
+    provinces = [make_province(loc) for loc in locations]
+    chapter07.crud_py_sync_coronavirus_data(db, provinces, locations)
+
+    stats = chapter07.crud_py_sync_coronavirus_data(db, provinces, [make_location("p1", timeline)])
+    assert stats == {"inserted": 1, "updated": 0, "unchanged": 9}
+    assert db.query(chapter07.models_py_Data).count() == 10
+    assert chapter07.crud_py_check_summary(db) == []
+
+
+class StubUpstream:
+    "本地模拟的JHU上游服务: 支持ETag条件请求,并可以让前几次请求返回503"
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.requests = []  # (timelines参数, 状态码)
+        self.fail_times = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                timelines = "timelines=true" in self.path
+                if stub.fail_times > 0:
+                    stub.fail_times -= 1
+                    return self.reply(timelines, 503, b"")
+                locations = stub.locations if timelines else [
+                    {k: v for k, v in loc.items() if k != "timelines"} for loc in stub.locations]
+                body = json.dumps({"locations": locations}).encode()
+                etag = f'"{hash(body)}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return self.reply(timelines, 304, b"")
+                self.reply(timelines, 200, body, {"ETag": etag, "Content-Type": "application/json"})
+
+            def reply(self, timelines, code, body, headers=None):
+                stub.requests.append((timelines, code))
+                self.send_response(code)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v2/locations"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def upstream():
+    stub = StubUpstream([make_location("p1", {"2020-01-01": (1, 0), "2020-01-02": (2, 0)})])
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+def test_bg_task_skips_sync_when_upstream_not_modified(db, upstream):
+    client = chapter07.upstream_py_Client(url=upstream.url, backoff_factor=0)
+    assert chapter07.bg_task(db, client=client) == {"inserted": 2, "updated": 0, "unchanged": 0}
+    assert sorted(upstream.requests) == [(False, 200), (True, 200)]
+
+    upstream.requests.clear()
+    assert chapter07.bg_task(db, client=client) == {"inserted": 0, "updated": 0, "unchanged": 0}
+    assert sorted(upstream.requests) == [(False, 304), (True, 304)]
+
+    upstream.requests.clear()
+    upstream.locations = [make_location("p1", {"2020-01-01": (1, 0), "2020-01-02": (2, 0), "2020-01-03": (3, 0)})]
+    assert chapter07.bg_task(db, client=client)["inserted"] == 1
+    # 省份数据没变(304)但时间线变了,省份数据不带条件头重新请求
+    assert sorted(upstream.requests) == [(False, 200), (False, 304), (True, 200)]
+
+
+def test_upstream_client_retries_with_backoff(upstream):
+    client = chapter07.upstream_py_Client(url=upstream.url, retries=2, backoff_factor=0)
+    upstream.fail_times = 2
+    assert client.get(timelines=False).json()["locations"][0]["province"] == "p1"
+
+    upstream.fail_times = 3
+    with pytest.raises(chapter07.requests.HTTPError):
+        client.get(timelines=False)
+
+
+def test_upstream_client_closes_responses(upstream, monkeypatch):
+    client = chapter07.upstream_py_Client(url=upstream.url, retries=0, backoff_factor=0)
+    responses = []
+    get = client.session.get
+    monkeypatch.setattr(client.session, "get", lambda *args, **kwargs: responses.append(get(*args, **kwargs)) or responses[-1])
+    client.remember(*client.fetch_locations())
+    for response in client.fetch_locations(conditional=False):
+        response.close()
+    responses.clear()
+    assert client.fetch_locations() is None
+    # 304的流式响应也要关闭,连接才会还给连接池
+    assert [response.status_code for response in responses] == [304, 304]
+    assert all(response.raw.closed for response in responses)
+
+    # 两份请求中一份失败时,另一份已经拿到的响应被关闭
+    responses.clear()
+    upstream.fail_times = 1
+    with pytest.raises(chapter07.requests.HTTPError):
+        client.fetch_locations(conditional=False)
+    assert sorted(response.status_code for response in responses) == [200, 503]
+    assert all(response.raw.closed for response in responses)
+
+
+def test_iter_json_array_parses_chunked_stream():
+    payload = {"latest": {"confirmed": 3, "locations": 0},
+               "locations": [make_location(f"省份{i}", {"2020-01-01": (i, 0)}) for i in range(3)]}
+    body = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+    for size in (1, 7, len(body)):
+        chunks = (body[i:i + size] for i in range(0, len(body), size))
+        assert list(chapter07.upstream_py_iter_json_array(chunks, "locations")) == payload["locations"]
+
+    with pytest.raises(ValueError):
+        list(chapter07.upstream_py_iter_json_array([body[:len(body) // 2]], "locations"))
+
+
+def test_get_data_query_count_is_constant(db, client, statements):
+    locations = [make_location(f"p{i}", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 21)}) for i in range(5)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    counts = []
+    for url in ("/chapter07/appstore/covid19/", "/chapter07/appstore/covid19/get_data"):
+        for limit in (5, 50):
+            statements.clear()
+            response = client.get(url, params={"limit": limit})
+            assert response.status_code == 200
+            counts.append(len(statements))
+        statements.clear()
+        assert client.get(url, params={"province_name": "p1"}).status_code == 200
+        counts.append(len(statements))
+    assert counts == [1] * len(counts)
+    assert client.get("/chapter07/appstore/covid19/get_data",
+                      params={"limit": 50}).json()[0]["province"]["province_name"] == "p0"
+
+
+def test_query_stats_headers_and_slow_query_log(db, client, statements, monkeypatch, caplog):
+    locations = [make_location(f"p{i}", {"2020-01-01": (1, 0)}) for i in range(3)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+    before = chapter07.database_py_query_metrics.stats()
+
+    statements.clear()
+    response = client.get("/chapter07/appstore/covid19/get_provinces", params={"limit": 2})
+    assert response.headers["X-DB-Queries"] == str(len(statements)) == "1"
+    assert float(response.headers["X-DB-Time"]) > 0
+    # 响应缓存命中时不执行SQL
+    response = client.get("/chapter07/appstore/covid19/get_provinces", params={"limit": 2})
+    assert response.headers["X-DB-Queries"] == "0"
+
+    after = chapter07.database_py_query_metrics.stats()
+    assert after["requests"] - before["requests"] == 2
+    assert after["queries"] - before["queries"] == 1
+
+    monkeypatch.setattr(chapter07, "SLOW_QUERY_SECONDS", 0)
+    with caplog.at_level(logging.WARNING, logger=chapter07.__name__):
+        client.get("/chapter07/appstore/covid19/get_provinces", params={"skip": 1, "limit": 2})
+    slow = [r.getMessage() for r in caplog.records if r.getMessage().startswith("slow query")]
+    assert len(slow) == 1 and "LIMIT ? OFFSET ?" in slow[0] and "\n" not in slow[0]
+    assert chapter07.database_py_normalize_sql(
+        "SELECT * FROM data\n WHERE id IN (?, ?, ?) AND province_name = 'p''1' AND x > 10") == \
+        "SELECT * FROM data WHERE id IN (?...) AND province_name = ? AND x > ?"
+
+
+def test_query_stats_discard_failed_statements(session_factory):
+    engine = session_factory.kw["bind"]
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute("SELECT * FROM no_such_table")
+        # 出错的语句不会在连接上留下开始时间
+        assert connection.info["query_start"] == []
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_list_endpoints_serialize_rows(db, client, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(chapter07, "orjson", None)  # 退回标准库json
+    elif chapter07.orjson is None:
+        pytest.skip("orjson is not installed")
+    locations = [make_location(f"p{i}", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 4)}) for i in range(2)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    # 和原来ORM对象经过jsonable_encoder的结果相同
+    expected = jsonable_encoder(chapter07.crud_py_get_data(db, None, 0, 10))
+    response = client.get("/chapter07/appstore/covid19/get_data", params={"limit": 10})
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == expected
+    assert response.json()[0]["date"] == "2020-01-01" and "T" in response.json()[0]["created_at"]
+    assert client.get("/chapter07/appstore/covid19/get_data", params={"province_name": "p1"}).json() == expected[3:]
+    page = client.get("/chapter07/appstore/covid19/get_data", params={"cursor": "", "limit": 4}).json()
+    assert page["items"] == expected[:4] and page["next_cursor"]
+
+    provinces = db.query(chapter07.models_py_Province).order_by(chapter07.models_py_Province.id).all()
+    expected = [chapter07.schemas_py_Read_Province.from_orm(p).dict() for p in provinces]
+    assert client.get("/chapter07/appstore/covid19/get_provinces").json() == jsonable_encoder(expected)
+    page = client.get("/chapter07/appstore/covid19/get_provinces", params={"cursor": "", "limit": 1}).json()
+    assert page["items"] == jsonable_encoder(expected[:1]) and page["next_cursor"]
+
+
+def test_export_streams_ndjson_and_csv(db, client):
+    locations = [make_location(f"p{i}", {f"2020-01-{d:02d}": (d * 10 + i, i) for d in range(1, 6)}) for i in range(3)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    response = client.get("/chapter07/appstore/covid19/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert "etag" not in response.headers  # 不进入响应缓存
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 15
+    assert rows[0] == {"province_id": 1, "province_name": "p0", "country_code": "CN", "date": "2020-01-01",
+                       "confirm_num": 10, "death_num": 0, "cure_num": 0}
+    assert [(r["province_name"], r["date"]) for r in rows] == sorted((r["province_name"], r["date"]) for r in rows)
+
+    response = client.get("/chapter07/appstore/covid19/export", params={
+        "format": "csv", "province_name": "p2", "start_date": "2020-01-02", "end_date": "2020-01-03"})
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == 'attachment; filename="covid19.csv"'
+    assert response.text.splitlines() == [
+        "province_id,province_name,country_code,date,confirm_num,death_num,cure_num",
+        "3,p2,CN,2020-01-02,22,2,0",
+        "3,p2,CN,2020-01-03,32,2,0",
+    ]
+    assert client.get("/chapter07/appstore/covid19/export", params={"province_name": "nowhere"}).status_code == 404
+    assert client.get("/chapter07/appstore/covid19/export", params={"format": "xml"}).status_code == 422
+
+    # 按批取回,每批最多batch_size行
+    batches = list(chapter07.crud_py_iter_export(db, batch_size=4))
+    assert [len(batch) for batch in batches] == [4, 4, 4, 3]
+
+
+def test_export_arrow(db, client, monkeypatch):
+    pyarrow = pytest.importorskip("pyarrow")
+    locations = [make_location(f"省{i}", {f"2020-01-{d:02d}": (d * 10 + i, i) for d in range(1, 6)}) for i in range(3)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+    monkeypatch.setattr(chapter07, "EXPORT_BATCH_SIZE", 4)
+
+    response = client.get("/chapter07/appstore/covid19/export", params={"format": "arrow"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    reader = pyarrow.ipc.open_stream(response.content)
+    assert reader.schema == chapter07.responses_py_arrow_schema()
+    batches = list(reader)
+    assert [batch.num_rows for batch in batches] == [4, 4, 4, 3]
+    table = pyarrow.Table.from_batches(batches)
+    assert table.column("province").chunk(0).dictionary.to_pylist() == ["省0", "省1", "省2"]
+    assert table.slice(5, 1).to_pylist() == [
+        {"date": date(2020, 1, 1), "province": "省1", "confirm_num": 11, "death_num": 1, "cure_num": 0}]
+
+    response = client.get("/chapter07/appstore/covid19/export", params={"format": "arrow", "province_name": "省2",
+                                                                        "start_date": "2020-01-05"})
+    assert pyarrow.ipc.open_stream(response.content).read_all().to_pylist() == [
+        {"date": date(2020, 1, 5), "province": "省2", "confirm_num": 52, "death_num": 2, "cure_num": 0}]
+    response = client.get("/chapter07/appstore/covid19/export", params={"format": "arrow", "start_date": "2021-01-01"})
+    assert pyarrow.ipc.open_stream(response.content).read_all().num_rows == 0
+
+    monkeypatch.setattr(chapter07, "pyarrow", None)
+    assert client.get("/chapter07/appstore/covid19/export", params={"format": "arrow"}).status_code == 501
+
+
+def test_create_data_batch(db, client, statements, monkeypatch):
+    locations = [make_location(f"p{i}", {"2020-01-01": (1, 0)}) for i in range(2)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+    chapter07.cache_py_province_cache.invalidate()
+    version = chapter07.cache_py_data_version.value
+
+    def item(province_name, day, confirm_num=10):
+        return {"province_name": province_name, "date": f"2020-01-{day:02d}",
+                "confirm_num": confirm_num, "death_num": 0, "cure_num": 0}
+
+    items = [item("p0", d) for d in range(2, 12)] + [item("p1", 3, 5)] + [
+        item("nowhere", 2),  # 11: 省份不存在
+        item("p0", 1),  # 12: 数据库中已存在
+        item("p0", 5),  # 13: 和第3条重复
+        {"province_name": "p1", "date": "not a date", "confirm_num": 1, "death_num": 0, "cure_num": 0},  # 14
+    ]
+    statements.clear()
+    response = client.post("/chapter07/appstore/covid19/create_data/batch", json=items)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["received"] == 15 and result["inserted"] == 11
+    assert [error["index"] for error in result["errors"]] == [11, 12, 13, 14]
+    assert result["errors"][0]["detail"] == "province not found: nowhere"
+    assert result["errors"][2]["detail"] == "duplicate of item 3"
+    assert result["errors"][3]["detail"][0]["loc"] == ["date"]
+    # 省份ID一次解析,写入在一个事务中完成: 查询和executemany的条数和批次大小无关
+    assert sum(statement.lstrip().startswith("SELECT province.province_name") for statement in statements) == 1
+    assert sum(statement.startswith("INSERT INTO data") for statement in statements) == 1
+    assert chapter07.cache_py_data_version.value > version
+    assert len(chapter07.crud_py_get_data(db, province_name="p0")) == 11
+    assert chapter07.crud_py_check_summary(db) == []
+
+    # NDJSON请求体,坏行作为单独的错误返回
+    body = "\n".join([json.dumps(item("p1", 4)), "{not json", json.dumps(item("p1", 4))]) + "\n"
+    response = client.post("/chapter07/appstore/covid19/create_data/batch", data=body,
+                           headers={"Content-Type": "application/x-ndjson"})
+    result = response.json()
+    assert result["inserted"] == 1 and [error["index"] for error in result["errors"]] == [1, 2]
+    assert client.post("/chapter07/appstore/covid19/create_data/batch", json={"a": 1}).status_code == 400
+
+    # 超过大小限制的请求体在解析之前就被拒绝
+    monkeypatch.setattr(chapter07, "CREATE_DATA_BATCH_MAX_BYTES", 100)
+    parsed = []
+    monkeypatch.setattr(chapter07, "parse_data_batch", lambda *args, **kwargs: parsed.append(1))
+    response = client.post("/chapter07/appstore/covid19/create_data/batch", json=[item("p1", d) for d in range(9)])
+    assert response.status_code == 413 and parsed == []
+
+
+def test_keyset_pagination(db, client):
+    locations = [make_location(f"p{i}", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 8)}) for i in range(3)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    pages, cursor = [], ""
+    while cursor is not None:
+        page = client.get("/chapter07/appstore/covid19/get_data", params={"cursor": cursor, "limit": 4}).json()
+        pages.append(page["items"])
+        cursor = page["next_cursor"]
+    assert [len(items) for items in pages] == [4, 4, 4, 4, 4, 1]
+    keyset_ids = [row["id"] for items in pages for row in items]
+    offset_ids = [row["id"] for row in client.get("/chapter07/appstore/covid19/get_data",
+                                                  params={"limit": 100}).json()]
+    assert keyset_ids == offset_ids
+
+    page = client.get("/chapter07/appstore/covid19/get_data",
+                      params={"cursor": "", "limit": 5, "province_name": "p1"}).json()
+    page = client.get("/chapter07/appstore/covid19/get_data",
+                      params={"cursor": page["next_cursor"], "limit": 5, "province_name": "p1"}).json()
+    assert [row["date"] for row in page["items"]] == ["2020-01-06", "2020-01-07"]
+    assert page["next_cursor"] is None
+
+    page = client.get("/chapter07/appstore/covid19/get_provinces", params={"cursor": "", "limit": 2}).json()
+    assert [p["province_name"] for p in page["items"]] == ["p0", "p1"]
+    page = client.get("/chapter07/appstore/covid19/get_provinces", params={"cursor": page["next_cursor"]}).json()
+    assert [p["province_name"] for p in page["items"]] == ["p2"] and page["next_cursor"] is None
+    assert len(client.get("/chapter07/appstore/covid19/get_provinces").json()) == 3
+
+    response = client.get("/chapter07/appstore/covid19/get_data", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+    for url in ("/chapter07/appstore/covid19/get_data", "/chapter07/appstore/covid19/get_provinces"):
+        for limit in (0, -1):
+            assert client.get(url, params={"cursor": "", "limit": limit}).status_code == 422
+
+    # 同一省份同一天的数据已存在: 违反唯一索引,回滚后返回409
+    response = client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p1"},
+                           json={"date": "2020-01-03", "confirm_num": 9, "death_num": 0, "cure_num": 0})
+    assert response.status_code == 409
+    response = client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p1"},
+                           json={"date": "2020-01-08", "confirm_num": 9, "death_num": 0, "cure_num": 0})
+    assert response.status_code == 200
+    assert chapter07.crud_py_check_summary(db) == []
+
+
+def test_create_all_adds_missing_indexes(session_factory, caplog):
+    engine = session_factory.kw["bind"]
+    # 模拟旧版本建好的数据库: 表已存在,但没有后来加到模型上的索引
+    engine.execute("DROP INDEX ix_data_province_id_date")
+    engine.execute("DROP INDEX ix_data_date")
+    engine.execute("INSERT INTO province (id, province_name, country_name, country_code, country_population) "
+                   "VALUES (1, 'p1', 'China', 'CN', 1)")
+    for _ in range(2):
+        engine.execute("INSERT INTO data (province_id, date, confirm_num, death_num, cure_num) "
+                       "VALUES (1, '2020-01-01', 1, 0, 0)")
+    with caplog.at_level(logging.ERROR, logger=chapter07.__name__):
+        chapter07.database_py_create_all(engine)
+    indexes = {index["name"] for index in sqlalchemy_inspect(engine).get_indexes("data")}
+    assert "ix_data_date" in indexes and "ix_data_province_id_date" not in indexes
+    assert "duplicate rows" in caplog.text
+
+    # 清理重复数据之后再次启动,补建唯一索引
+    engine.execute("DELETE FROM data WHERE id = 2")
+    chapter07.database_py_create_all(engine)
+    indexes = {index["name"]: index for index in sqlalchemy_inspect(engine).get_indexes("data")}
+    assert indexes["ix_data_province_id_date"]["unique"]
+
+
+def test_lru_cache_ttl_and_version():
+    now = [0.0]
+    cache = chapter07.cache_py_LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.update({"a": 1, "b": 2})
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # 淘汰最久未使用的b
+    assert cache.get("b") is None and cache.get("c") == 3
+    now[0] = 10
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 2, "misses": 2, "size": 1, "maxsize": 2}
+
+    # 带数据版本号的缓存项: 版本号不同视为未命中并删除
+    cache.set("page", b"body", version=1)
+    assert cache.get("page", version=1) == b"body"
+    assert cache.get("page", version=2) is None and cache.get("page", version=1) is None
+
+
+def test_province_ids_resolved_from_cache(db, client, statements):
+    timeline = {"2020-01-01": (1, 0)}
+    locations = [make_location("p1", timeline)]
+    chapter07.crud_py_sync_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    statements.clear()
+    response = client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p1"},
+                           json={"date": "2020-01-02", "confirm_num": 2, "death_num": 0, "cure_num": 0})
+    assert response.status_code == 200
+    assert not any("province.province_name" in statement for statement in statements)
+
+    response = client.post("/chapter07/appstore/covid19/create_province", json={
+        "province_name": "p2", "country_name": "China", "country_code": "CN", "country_population": 1})
+    assert response.status_code == 200
+    assert chapter07.cache_py_province_cache.get("p2") is None  # 新建省份时失效
+    assert client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p3"},
+                       json={"date": "2020-01-02", "confirm_num": 2, "death_num": 0, "cure_num": 0}).status_code == 404
+    assert client.get("/chapter07/appstore/covid19/metrics/province_cache").json()["size"] == 1
+
+
+def test_daily_stats_and_latest(db, client):
+    locations = [make_location("p1", {f"2020-01-{d:02d}": (d * d, d) for d in range(1, 11)}),
+                 make_location("p2", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 9)})]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    stats = client.get("/chapter07/appstore/covid19/stats/daily",
+                       params={"start_date": "2020-01-05", "end_date": "2020-01-08", "window": 3}).json()
+    assert [row["date"] for row in stats] == ["2020-01-05", "2020-01-06", "2020-01-07", "2020-01-08"]
+    # 全国合计: 第d天累计确诊 d*d + d, 日增量 2d
+    assert stats[0]["confirm_num"] == 30 and stats[0]["confirm_delta"] == 10
+    assert stats[0]["confirm_avg"] == pytest.approx((6 + 8 + 10) / 3)
+    assert stats[-1]["death_num"] == 8 and stats[-1]["death_delta"] == 1
+
+    stats = client.get("/chapter07/appstore/covid19/stats/daily", params={"province_name": "p2"}).json()
+    assert len(stats) == 8 and stats[0]["confirm_delta"] == 1 and stats[0]["confirm_avg"] == 1
+
+    latest = client.get("/chapter07/appstore/covid19/stats/latest").json()
+    assert [(row["province_name"], row["date"], row["confirm_num"]) for row in latest] == [
+        ("p1", "2020-01-10", 100), ("p2", "2020-01-08", 8)]
+
+
+def test_daily_stats_with_sparse_dates(db):
+    # p1隔天才有数据, p2的数据在1月6日之后就结束了
+    locations = [make_location("p1", {f"2020-01-{d:02d}": (d * d, 0) for d in range(1, 20, 2)}),
+                 make_location("p2", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 7)})]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    for province_name in (None, "p1"):
+        full = chapter07.crud_py_compute_daily_stats(db, province_name, window=3)
+        # 指定起始日期时,回看按行数而不是天数,结果和全量计算的对应部分相同
+        for start in (date(2020, 1, 8), date(2020, 1, 11)):
+            assert chapter07.crud_py_compute_daily_stats(db, province_name, start, window=3) == [
+                row for row in full if row["date"] >= start]
+    rows = {row["date"]: row for row in chapter07.crud_py_compute_daily_stats(db, window=3)}
+    # 全国的日增量是各省份日增量之和: p2的数据结束后不会出现负的增量
+    assert rows[date(2020, 1, 7)]["confirm_delta"] == 7 * 7 - 5 * 5
+    assert rows[date(2020, 1, 9)]["confirm_avg"] == pytest.approx((1 + 24 + 32) / 3)  # 6日、7日、9日三行
+
+
+def test_summary_with_sparse_dates(db):
+    locations = [make_location("p1", {f"2020-01-{d:02d}": (d * d, 0) for d in range(1, 20, 2)}),
+                 make_location("p2", {f"2020-01-{d:02d}": (d, 0) for d in range(1, 7)})]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+    # 隔天的数据上增量刷新汇总表: 回看按行数,不是按天数
+    chapter07.crud_py_create_province_data(db, chapter07.schemas_py_Create_Data(
+        date=date(2020, 1, 21), confirm_num=500, death_num=0, cure_num=0), province_id=1)
+    assert chapter07.crud_py_check_summary(db) == []
+
+    # 读汇总表(window=SUMMARY_WINDOW)和在data表上计算的结果相同,包括某个省份数据提前结束的日期
+    for province_name in (None, "p1", "p2"):
+        for start in (None, date(2020, 1, 7), date(2020, 1, 12)):
+            assert chapter07.crud_py_get_daily_stats(db, province_name, start) == \
+                chapter07.crud_py_compute_daily_stats(db, province_name, start)
+
+
+def test_summary_maintained_incrementally(db, client):
+    timeline = {f"2020-01-{d:02d}": (d * d, 0) for d in range(1, 16)}
+    locations = [make_location("p1", timeline), make_location("p2", timeline)]
+    provinces = [make_province(loc) for loc in locations]
+    chapter07.crud_py_reload_coronavirus_data(db, provinces, locations)
+    assert chapter07.crud_py_check_summary(db) == []
+
+    # 增量同步: p1修正一天并新增一天; 之后单条写入p2的新数据
+    locations = [make_location("p1", dict(timeline, **{"2020-01-14": (200, 0), "2020-01-16": (256, 0)})),
+                 make_location("p2", timeline)]
+    chapter07.crud_py_sync_coronavirus_data(db, provinces, locations)
+    assert client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p2"},
+                       json={"date": "2020-01-16", "confirm_num": 300, "death_num": 0, "cure_num": 0}).status_code == 200
+    assert chapter07.crud_py_check_summary(db) == []
+
+    stats = client.get("/chapter07/appstore/covid19/stats/daily", params={"province_name": "p1"}).json()
+    assert [row["confirm_delta"] for row in stats[-3:]] == [200 - 169, 225 - 200, 256 - 225]
+    assert stats[-1]["confirm_avg"] == pytest.approx((256 - 9 * 9) / 7)
+    latest = client.get("/chapter07/appstore/covid19/stats/latest").json()
+    assert [row["confirm_num"] for row in latest] == [256, 300]
+
+    # 汇总表被改坏时检查器能发现,并可以修复
+    db.query(chapter07.models_py_ProvinceDailySummary).filter_by(date=date(2020, 1, 3)).delete()
+    db.commit()
+    response = client.get("/chapter07/appstore/covid19/stats/check_summary").json()
+    assert response["mismatch_count"] == 2 and not response["repaired"]
+    assert client.get("/chapter07/appstore/covid19/stats/check_summary", params={"repair": True}).json()[
+        "mismatch_count"] == 2  # GET不修改数据
+    response = client.post("/chapter07/appstore/covid19/stats/repair_summary").json()
+    assert response["mismatch_count"] == 2 and response["repaired"]
+    assert chapter07.crud_py_check_summary(db) == []
+
+    # 旧数据库: data表有数据,汇总表是新建的空表,启动时补齐
+    db.query(chapter07.models_py_ProvinceDailySummary).delete()
+    db.commit()
+    assert client.get("/chapter07/appstore/covid19/stats/latest").json() == []
+    assert chapter07.crud_py_backfill_summary(db)
+    assert not chapter07.crud_py_backfill_summary(db)
+    assert chapter07.crud_py_check_summary(db) == []
+    assert [row["confirm_num"] for row in client.get("/chapter07/appstore/covid19/stats/latest").json()] == [256, 300]
+
+
+def test_response_cache_etag_and_invalidation(db, client, statements):
+    locations = [make_location("p1", {"2020-01-01": (1, 0)})]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+
+    etags = {}
+    for url in ("/chapter07/appstore/covid19/get_data", "/chapter07/appstore/covid19/"):
+        first = client.get(url)
+        etag = etags[url] = first.headers["ETag"]
+        statements.clear()
+        second = client.get(url)
+        assert second.content == first.content and second.headers["ETag"] == etag
+        not_modified = client.get(url, headers={"If-None-Match": etag})
+        assert not_modified.status_code == 304 and not_modified.content == b""
+        assert statements == []  # 缓存命中时不访问数据库
+
+    # 写接口提交之后数据版本号变化,缓存失效
+    response = client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p1"},
+                           json={"date": "2020-01-02", "confirm_num": 2, "death_num": 0, "cure_num": 0})
+    assert response.status_code == 200
+    response = client.get("/chapter07/appstore/covid19/get_data",
+                          headers={"If-None-Match": etags["/chapter07/appstore/covid19/get_data"]})
+    assert response.status_code == 200 and len(response.json()) == 2
+    assert client.get("/chapter07/appstore/covid19/get_province/p2").status_code == 404
+
+
+def test_home_page_fragment_cache(db, client, statements, monkeypatch):
+    locations = [make_location(f"p{i}", {"2020-01-01": (i, 0)}) for i in range(3)]
+    chapter07.crud_py_reload_coronavirus_data(db, [make_province(loc) for loc in locations], locations)
+    url_for = []
+    monkeypatch.setattr(chapter07.Request, "url_for", lambda self, name, **kwargs: url_for.append(name) or "/static/x")
+
+    first = client.get("/chapter07/appstore/covid19/", params={"limit": 2})
+    assert first.status_code == 200
+    assert first.text.count("<tr>") == 3 and "<td>p1</td>" in first.text and "<td>p2</td>" not in first.text
+    assert len(url_for) == 3  # 3个静态文件地址;<tr>中有1个是表头
+
+    # 响应缓存失效(如TTL过期)之后,表格片段和静态文件地址仍然命中缓存: 不查询数据库,只渲染页面外壳
+    chapter07.cache_py_response_cache.clear()
+    statements.clear()
+    second = client.get("/chapter07/appstore/covid19/", params={"limit": 2})
+    assert second.text == first.text
+    assert statements == [] and len(url_for) == 3
+    assert chapter07.cache_py_fragment_cache.stats()["hits"] == 1
+
+    # 查询参数不同是不同的片段;写库之后数据版本号变化,片段失效
+    assert "<td>p2</td>" in client.get("/chapter07/appstore/covid19/", params={"province_name": "p2"}).text
+    response = client.post("/chapter07/appstore/covid19/create_data", params={"province_name": "p1"},
+                           json={"date": "2020-01-02", "confirm_num": 5, "death_num": 0, "cure_num": 0})
+    assert response.status_code == 200
+    chapter07.cache_py_response_cache.clear()
+    third = client.get("/chapter07/appstore/covid19/", params={"province_name": "p1"})
+    assert third.text.count("<tr>") == 3 and "<td>2020-01-02</td>" in third.text
+
+
+def test_templates_profile(tmp_path):
+    dev = chapter07.templates_py_Templates(chapter07.TEMPLATES_DIRECTORY, profile="dev")
+    assert dev.env.auto_reload and dev.env.bytecode_cache is None
+
+    prod = chapter07.templates_py_Templates(chapter07.TEMPLATES_DIRECTORY, profile="prod",
+                                            bytecode_cache_dir=str(tmp_path))
+    assert not prod.env.auto_reload
+    prod.get_template("home.html")
+    # 编译结果写入了字节码缓存,新的进程(这里用新的渲染器代替)直接加载
+    assert len(list(tmp_path.iterdir())) == 1
+    other = chapter07.templates_py_Templates(chapter07.TEMPLATES_DIRECTORY, profile="prod",
+                                             bytecode_cache_dir=str(tmp_path))
+    assert other.get_template("home_table.html").render(data=[]).strip() == ""
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_prod_engine_profile(session_factory):
+    engine = session_factory.kw["bind"]
+    assert not engine.echo
+    with engine.connect() as connection:
+        assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.execute("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert connection.execute("PRAGMA busy_timeout").scalar() == 5000
+    with pytest.raises(ValueError):
+        chapter07.database_py_create_engine("sqlite://", profile="staging")
+
+
+class BlockingClient(chapter07.upstream_py_Client):
+    "请求上游之前等待release事件,用来控制同步任务执行到哪一步"
+
+    def __init__(self, url):
+        super().__init__(url=url, backoff_factor=0)
+        self.release = threading.Event()
+        self.responses = []
+
+    def fetch_locations(self, conditional=True):
+        assert self.release.wait(5)
+        responses = super().fetch_locations(conditional)
+        self.responses.append(responses)
+        return responses
+
+
+def wait_finished(client, job_id):
+    for _ in range(500):
+        job = client.get(f"/chapter07/appstore/covid19/sync_jobs/{job_id}").json()
+        if job["status"] in ("succeeded", "failed", "cancelled"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"sync job {job_id} did not finish")
+
+
+def test_sync_jobs_coalesce_and_cancel(db, client, session_factory, upstream):
+    upstream_client = BlockingClient(upstream.url)
+    runner = chapter07.job_py_SyncJobRunner(session_factory, upstream_client)
+    client.app.dependency_overrides[chapter07.get_sync_runner] = lambda: runner
+    sync_url = "/chapter07/appstore/covid19/sync_coronavirus_data/jhu"
+
+    first = client.get(sync_url).json()
+    second = client.get(sync_url, params={"mode": "full"}).json()
+    assert not first["coalesced"] and second["coalesced"] and second["job_id"] == first["job_id"]
+    cancelled = client.post(f"/chapter07/appstore/covid19/sync_jobs/{first['job_id']}/cancel").json()
+    assert cancelled["status"] == "running"
+    upstream_client.release.set()
+    assert wait_finished(client, first["job_id"])["status"] == "cancelled"
+    assert db.query(chapter07.models_py_Data).count() == 0
+    assert upstream_client.responses[0][1].raw.closed  # 取消时流式响应也被关闭
+
+    job = client.get(sync_url).json()
+    assert not job["coalesced"] and job["job_id"] != first["job_id"]
+    job = wait_finished(client, job["job_id"])
+    assert job["status"] == "succeeded" and job["rows_processed"] == 2 and job["locations_total"] == 1
+    assert job["result"] == {"inserted": 2, "updated": 0, "unchanged": 0}
+    assert db.query(chapter07.models_py_Data).count() == 2
+    assert client.get("/chapter07/appstore/covid19/sync_jobs/unknown").status_code == 404
+
+
+def test_sync_scheduler_single_leader_and_backoff(session_factory, upstream, tmp_path):
+    lock_path = str(tmp_path / "sync.lock")
+    runner = chapter07.job_py_SyncJobRunner(session_factory, chapter07.upstream_py_Client(url=upstream.url))
+    leader = chapter07.job_py_SyncScheduler(runner, interval=0.05, jitter=0, lock_path=lock_path)
+    follower = chapter07.job_py_SyncScheduler(runner, interval=0.05, jitter=0, lock_path=lock_path)
+    leader.start()
+    try:
+        for _ in range(500):
+            if leader.runs >= 2:
+                break
+            time.sleep(0.01)
+        assert leader.runs >= 2 and leader.failures == 0
+        assert not follower.acquire_lock()  # 另一个"worker"拿不到锁,不会同步
+    finally:
+        leader.stop()
+    assert follower.acquire_lock()  # 持锁的一方停止后可以接替
+    follower.stop()
+
+    upstream.fail_times = 100
+    runner.client = chapter07.upstream_py_Client(url=upstream.url, retries=0)
+    scheduler = chapter07.job_py_SyncScheduler(runner, interval=10, jitter=0, max_backoff=25, lock_path=lock_path)
+    assert scheduler.run_once().status == "failed"
+    assert scheduler.next_delay() == 20
+    scheduler.run_once()
+    assert scheduler.next_delay() == 25
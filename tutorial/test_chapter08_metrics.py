@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = '__Jack__'
+
+import timeit
+
+from fastapi import APIRouter, FastAPI
+from fastapi.staticfiles import StaticFiles
+from fastapi.testclient import TestClient
+
+from tutorial.chapter08 import MetricsMiddleware, MetricsRegistry
+
+"""Testing 第八章指标中间件的测试用例(自己构造app,不导入run.py)"""
+
+
+def make_metrics_app():
+    registry = MetricsRegistry()
+    metrics_app = FastAPI()
+    metrics_app.add_middleware(MetricsMiddleware, registry=registry)
+    metrics_app.add_route('/metrics', registry.endpoint, include_in_schema=False)
+    metrics_app.mount(path='/static', app=StaticFiles(directory='./tutorial/static'), name='static')
+    router = APIRouter()
+
+    @router.post("/items/{item_id}")
+    def create_item(item_id: int, body: dict):
+        return {"item_id": item_id, **body}
+
+    metrics_app.include_router(router, prefix='/chapter08')
+    return metrics_app, registry
+
+
+def test_metrics_middleware():
+    metrics_app, registry = make_metrics_app()
+    metrics_client = TestClient(metrics_app)
+    for item_id in (1, 2):
+        response = metrics_client.post(f"/chapter08/items/{item_id}", json={"name": "x"})
+        assert response.status_code == 200
+        assert float(response.headers["X-Process-Time"]) > 0
+    metrics_client.post("/chapter08/items/abc", json={})  # 422
+    metrics_client.get("/no/such/path")  # 404
+
+    # 按路由模板而不是实际路径聚合
+    route = ("POST", "/chapter08/items/{item_id}", 200)
+    assert registry.duration.series[route][-1] == 2
+    assert registry.duration.series[("POST", "/chapter08/items/{item_id}", 422)][-1] == 1
+    assert registry.duration.series[("GET", "<unmatched>", 404)][-1] == 1
+    assert registry.request_size.series[route[:2]][-2] == 2 * len(b'{"name": "x"}') + len(b'{}')  # 包括422的请求
+    assert registry.response_size.series[route][-2] == len(b'{"item_id":1,"name":"x"}') * 2
+    assert registry.in_flight == 0
+
+    metrics_client.get("/static/css/semantic.min.css")
+    text = metrics_client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="POST",route="/chapter08/items/{item_id}",status="200"} 2' in text
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/chapter08/items/{item_id}",status="200",le="+Inf"} 2' in text
+    assert 'route="/static/{path}"' in text
+    assert "http_requests_in_flight 1" in text  # 就是/metrics这个请求自己
+
+
+def test_metrics_collectors():
+    registry = MetricsRegistry()
+    registry.register_stats("demo_cache", lambda: {"hits": 3, "size": 1}, "demo")
+    text = registry.render()
+    assert "# TYPE demo_cache_hits_total counter\ndemo_cache_hits_total 3" in text
+    assert "# TYPE demo_cache_size gauge\ndemo_cache_size 1" in text
+
+
+def test_metrics_hot_path_overhead():
+    "中间件在每个请求上额外的开销只有几微秒"
+    registry = MetricsRegistry()
+    scope = {"type": "http", "method": "GET", "headers": [(b"host", b"testserver"), (b"accept", b"*/*")],
+             "endpoint": test_metrics_hot_path_overhead, "app": FastAPI()}
+
+    async def inner(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def noop(message=None):
+        return {"type": "http.request", "body": b""}
+
+    middleware = MetricsMiddleware(inner, registry)
+
+    def run(app):
+        coroutine = app(dict(scope), noop, noop)
+        try:
+            coroutine.send(None)
+        except StopIteration:
+            pass
+
+    number = 20000
+    bare = min(timeit.repeat(lambda: run(inner), number=number, repeat=5)) / number
+    wrapped = min(timeit.repeat(lambda: run(middleware), number=number, repeat=5)) / number
+    assert wrapped - bare < 20e-6